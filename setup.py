@@ -21,7 +21,8 @@ console_scripts = [
     'wormtracker_commands=wormtracker_scope.devices.commands:main',
     'wormtracker_tracker=wormtracker_scope.devices.tracker:main',
     'wormtracker=wormtracker_scope.system.wormtracker:main',
-    'wormtracker_teensy_commands=wormtracker_scope.devices.teensy_commands:main'
+    'wormtracker_teensy_commands=wormtracker_scope.devices.teensy_commands:main',
+    'wormtracker_teensy_simulator=wormtracker_scope.devices.teensy_simulator:main'
 ]
 
 setuptools.setup(
@@ -43,5 +44,5 @@ setuptools.setup(
         'console_scripts': console_scripts
     },
     packages=['wormtracker_scope'],
-    python_requires=">=3.6",
+    python_requires=">=3.8",
 )
@@ -0,0 +1,45 @@
+"""Drive TeensyCommandsDevice against the pty teensy simulator."""
+
+import os
+import time
+import threading
+
+import pytest
+
+pytest.importorskip("serial")
+if os.name != "posix":
+    pytest.skip("the simulator needs a pseudo terminal", allow_module_level=True)
+
+from wormtracker_scope.devices.teensy_simulator import TeensySimulator
+from wormtracker_scope.devices.teensy_commands import TeensyCommandsDevice
+
+@pytest.fixture
+def simulator():
+    simulator = TeensySimulator()
+    thread = threading.Thread(target=simulator.run, daemon=True)
+    thread.start()
+    yield simulator
+    simulator.shutdown()
+    thread.join()
+    simulator.close()
+
+def test_move_xyz_sends_one_v_line(simulator):
+    device = TeensyCommandsDevice(
+        inbound=("localhost", 5101, False),
+        outbound=("localhost", 5100, False),
+        port=simulator.port)
+
+    device.command_subscriber.process(b"teensy_commands move_xyz 100 -50.5 2")
+    time.sleep(0.2)
+    simulator.update()
+    (x, y, z) = simulator.position
+    device.shutdown()
+
+    lines = list(simulator.history)
+    assert lines[0] == b"e"
+    velocity_lines = [line for line in lines if line[:1] in (b"v", b"V")]
+    assert len(velocity_lines) == 1
+    assert velocity_lines[0][:1] == b"V"
+    assert [float(v) for v in velocity_lines[0][1:].split()] == [100, -50.5, 2]
+    assert x > 0 and y < 0 and z > 0
+    assert simulator.history[-1] == b"q"
@@ -28,7 +28,7 @@ from typing import Tuple
 
 from docopt import docopt
 
-from wormtracker_scope.zmq.publisher import Publisher
+from wormtracker_scope.zmq.publisher import RoutedPublisher
 from wormtracker_scope.zmq.subscriber import Subscriber
 from wormtracker_scope.zmq.utils import parse_host_and_port
 
@@ -42,9 +42,9 @@ class XboxStageCommands():
                                      inbound[0],
                                      inbound[2])
 
-        self.publisher = Publisher(outbound[1],
-                                   outbound[0],
-                                   outbound[2])
+        self.publisher = RoutedPublisher(outbound[1],
+                                         outbound[0],
+                                         outbound[2])
 
         buttons = [
             b"X pressed", b"Y pressed", b"B pressed",
@@ -142,14 +142,14 @@ class XboxStageCommands():
             elif tokens[0] == "left_stick":
                 xspeed = int(tokens[1]) // 50
                 yspeed = int(tokens[2]) // 50
-                self.publish("teensy_commands movey {}".format(yspeed))
-                self.publish("teensy_commands movex {}".format(-xspeed))
+                self.publisher.send_command("teensy_commands", "movey", yspeed)
+                self.publisher.send_command("teensy_commands", "movex", -xspeed)
 
             elif tokens[0] == "right_stick":
                 xspeed = int(tokens[1])
                 yspeed = int(tokens[2])
-                self.publish("teensy_commands movey {}".format(yspeed))
-                self.publish("teensy_commands movex {}".format(-xspeed))
+                self.publisher.send_command("teensy_commands", "movey", yspeed)
+                self.publisher.send_command("teensy_commands", "movex", -xspeed)
 
             else:
                 print("Unexpected message received: ", message)
@@ -23,6 +23,8 @@ Options:
                                             [default: UINT8_YX_512_512]
     --name=NAME                         This name is used for commands subscription.
                                             [default: data_hub]
+    --trace                             Append a latency trace to every frame.
+    --heartbeat=SECONDS                 Send a heartbeat to the hub this often.
 """
 
 import time
@@ -39,6 +41,8 @@ from wormtracker_scope.zmq.subscriber import ObjectSubscriber
 from wormtracker_scope.zmq.array import TimestampedPublisher, Subscriber
 from wormtracker_scope.devices.utils import array_props_from_string
 from wormtracker_scope.zmq.utils import parse_host_and_port
+from wormtracker_scope.zmq.trace import add_stamp
+from wormtracker_scope.zmq.heartbeat import Heartbeat
 
 class DataHub():
 
@@ -49,15 +53,21 @@ class DataHub():
             data_out: Tuple[str, int, bool],
             status_out: Tuple[str, int],
             fmt: str,
-            name: str):
+            name: str,
+            trace=False,
+            heartbeat=None):
 
         self.status = {}
         self.name = name
+        self.trace = trace
 
         self.data_in = data_in
         self.data_out = data_out
 
         self.device_status = 1
+        self.processed = 0
+        self.status_interval = 1.0
+        self.status_time = 0.0
 
         (self.dtype, _, self.shape) = array_props_from_string(fmt)
 
@@ -75,6 +85,8 @@ class DataHub():
             port=status_out[1],
             bound=status_out[2])
 
+        self.heartbeat = Heartbeat(self.publisher, name, heartbeat)
+
         self.data_publisher = TimestampedPublisher(
             host=self.data_out[0],
             port=self.data_out[1],
@@ -91,7 +103,7 @@ class DataHub():
 
         self.poller.register(self.command_subscriber.socket, zmq.POLLIN)
         self.poller.register(self.data_subscriber.socket, zmq.POLLIN)
-        time.sleep(0.9)
+        self.publisher.wait_for_subscribers(["hub", "logger"])
         self.publish_status()
 
     def set_shape(self, y, x):
@@ -117,29 +129,49 @@ class DataHub():
          and publish them with TimeStampedPublisher."""
         while self.device_status:
 
-            sockets = dict(self.poller.poll())
+            sockets = dict(self.poller.poll(self.heartbeat.poll_timeout()))
+            self.heartbeat.tick()
 
             if self.command_subscriber.socket in sockets:
-                _ = self.data_subscriber.get_last()
+                self.data_subscriber.discard()
                 self.command_subscriber.handle()
 
             elif self.data_subscriber.socket in sockets:
                 self.process()
 
     def process(self):
-        """This subscribes to a volume and publishes that volume to a port"""
+        """This subscribes to a volume and publishes that volume to a port.
+        The data publisher numbers the frames it sends, so every frame
+        leaving the data hub carries a sequence number."""
         vol = self.data_subscriber.get_last()
-        self.data_publisher.send(vol)
+        if vol is None:
+            return
+
+        trace = None
+        if self.trace:
+            trace = bytearray()
+            add_stamp(trace, "data_hub")
+
+        self.data_publisher.send(vol, trace=trace)
+        self.processed += 1
+
+        if time.time() - self.status_time >= self.status_interval:
+            self.publish_status()
 
     def update_status(self):
         """updates the status dictionary."""
         self.status["shape"] = self.shape
         self.status["device"] = self.device_status
+        self.status["frames"] = {
+            "received": self.data_subscriber.received,
+            "skipped": self.data_subscriber.dropped,
+            "processed": self.processed}
 
 
     def publish_status(self):
         """Publishes the status to the hub and logger."""
         self.update_status()
+        self.status_time = time.time()
         self.publisher.send("hub " + json.dumps({self.name: self.status}, default=int))
         self.publisher.send("logger " + json.dumps({self.name: self.status}, default=int))
 
@@ -154,7 +186,9 @@ def main():
         data_out=parse_host_and_port(args["--data_out"]),
         status_out=parse_host_and_port(args["--status_out"]),
         fmt=args["--format"],
-        name=args["--name"])
+        name=args["--name"],
+        trace=args["--trace"],
+        heartbeat=args["--heartbeat"] and float(args["--heartbeat"]))
 
     device.run()
 
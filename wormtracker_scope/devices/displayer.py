@@ -66,7 +66,8 @@ class Displayer:
             port=self.inbound[1],
             shape=self.shape,
             datatype=self.dtype,
-            bound=self.inbound[2])
+            bound=self.inbound[2],
+            latest=True)
 
         self.poller.register(self.command_subscriber.socket, zmq.POLLIN)
         self.poller.register(self.data_subscriber.socket, zmq.POLLIN)
@@ -75,6 +76,8 @@ class Displayer:
         cv2.resizeWindow(self.name, self.shape[1], self.shape[0])
 
     def set_shape(self, y, x):
+        """Frames carry their own shape, so this is only needed to change
+        the expected shape before the first frame arrives."""
         self.poller.unregister(self.data_subscriber.socket)
 
         self.shape = (y, x)
@@ -93,6 +96,9 @@ class Displayer:
 
         if msg is not None:
             self.image = msg[1]
+            if self.image.shape != self.shape:
+                self.shape = self.image.shape
+                cv2.resizeWindow(self.name, self.shape[1], self.shape[0])
 
         cv2.imshow(self.name, self.image)
         cv2.waitKey(1)
@@ -0,0 +1,129 @@
+#! python
+#
+# Copyright 2022
+# Authors: Mahdi Torkashvand
+
+"""This contains focus metrics for the autofocus of the tracker. Larger
+values mean sharper images. The cost of every metric is recorded, so that
+the cheapest metric that works for a sample can be chosen."""
+
+import time
+import bisect
+from collections import OrderedDict
+
+import cv2
+import numpy as np
+
+def _smooth_numbers(limit):
+    """Return the sorted numbers up to limit with no prime factor above 5."""
+
+    numbers = []
+    n2 = 1
+    while n2 <= limit:
+        n3 = n2
+        while n3 <= limit:
+            n5 = n3
+            while n5 <= limit:
+                numbers.append(n5)
+                n5 *= 5
+            n3 *= 3
+        n2 *= 2
+
+    return sorted(numbers)
+
+_FFT_SIZES = _smooth_numbers(1 << 14)
+
+def fft_size(n: int) -> int:
+    """Return the largest size not above n that FFTs handle quickly."""
+    return _FFT_SIZES[max(bisect.bisect_right(_FFT_SIZES, n) - 1, 0)]
+
+def crop_to_fft_size(img):
+    """Return the center of img cropped to sizes FFTs handle quickly."""
+
+    (h, w) = img.shape
+    (fh, fw) = (fft_size(h), fft_size(w))
+    (y0, x0) = ((h - fh) // 2, (w - fw) // 2)
+
+    return img[y0:y0 + fh, x0:x0 + fw]
+
+class FocusMetrics():
+    """This computes focus metrics by name:
+
+    fft: mean log magnitude of the image with frequencies below size
+        removed, computed with a real FFT
+    laplacian: variance of the Laplacian
+    tenengrad: mean squared Sobel gradient
+    brenner: mean squared difference of pixels two columns apart
+    """
+
+    METRICS = ("fft", "laplacian", "tenengrad", "brenner")
+
+    def __init__(self, size=10, max_masks=4):
+
+        self.size = size
+        self.max_masks = max_masks
+        self.masks = OrderedDict()
+        self.costs = {name: [0, 0] for name in self.METRICS}
+
+    def get_mask(self, shape):
+        """Return the high pass mask of the real FFT of an image shape. Crop
+        shapes change with the bounding box, so only the masks of the last
+        max_masks shapes are kept."""
+
+        if shape in self.masks:
+            self.masks.move_to_end(shape)
+            return self.masks[shape]
+
+        (h, w) = shape
+        mask = np.ones((h, w // 2 + 1), dtype=np.float32)
+        mask[:self.size, :self.size] = 0
+        mask[h - self.size:, :self.size] = 0
+
+        self.masks[shape] = mask
+        if len(self.masks) > self.max_masks:
+            self.masks.popitem(last=False)
+
+        return mask
+
+    def fft(self, img) -> float:
+        img = crop_to_fft_size(img)
+        spectrum = np.fft.rfft2(img)
+        spectrum *= self.get_mask(img.shape)
+        recon = np.fft.irfft2(spectrum, s=img.shape)
+        return float(np.mean(20 * np.log(np.abs(recon) + 1e-9)))
+
+    def laplacian(self, img) -> float:
+        return float(cv2.Laplacian(img, cv2.CV_32F).var())
+
+    def tenengrad(self, img) -> float:
+        gx = cv2.Sobel(img, cv2.CV_32F, 1, 0, ksize=3)
+        gy = cv2.Sobel(img, cv2.CV_32F, 0, 1, ksize=3)
+        return float(np.mean(gx * gx + gy * gy))
+
+    def brenner(self, img) -> float:
+        diff = cv2.subtract(img[:, 2:], img[:, :-2], dtype=cv2.CV_32F)
+        return float(np.mean(diff * diff))
+
+    def __call__(self, img, metric="fft") -> float:
+        """Return the metric of img, or 0 if img is too small."""
+
+        if metric not in self.costs:
+            raise ValueError("Unknown focus metric: {}".format(metric))
+
+        if min(img.shape) <= 2 * self.size:
+            return 0.0
+
+        t0 = time.perf_counter_ns()
+        value = getattr(self, metric)(img)
+        cost = self.costs[metric]
+        cost[0] += 1
+        cost[1] += time.perf_counter_ns() - t0
+
+        return value
+
+    def cost_summary(self):
+        """Return the number of calls and the mean cost in microseconds of
+        every metric used."""
+
+        return {name: {"count": count, "mean_us": total // count // 1000}
+                for (name, (count, total)) in self.costs.items() if count}
@@ -21,6 +21,9 @@ Options:
                                             [default: hub]
     --framerate=NUMBER                  camera frame rate
                                             [default: 1]
+    --concurrent                        Run client requests on worker
+                                            threads, so slow requests do
+                                            not block others.
     
 """
 
@@ -39,15 +42,19 @@ class WormTrackerHub(Hub):
     """This is a central hub that is responsible for subscribing and publishing
     messages to all components of Lambda. Clients controlling the microscope
     should communicate only with this."""
+
+    _DEVICES = ["displayer", "writer", "FlirCamera", "data_hub", "tracker",
+                "teensy_commands"]
     def __init__(
             self,
             inbound,
             outbound,
             server,
             framerate,
-            name="hub"):
+            name="hub",
+            concurrent=False):
 
-        Hub.__init__(self, inbound, outbound, server, name)
+        Hub.__init__(self, inbound, outbound, server, name, concurrent)
         self.framerate=framerate
 
     def toggle_recording(self, state):
@@ -65,7 +72,11 @@ class WormTrackerHub(Hub):
         self._writer_shutdown()
         self._displayer_shutdown()
         self._teensy_commands_shutdown()
-        time.sleep(0.5)
+        # Devices unsubscribe when they exit, after their last status
+        # messages have been sent to the logger. With --concurrent this runs
+        # on a worker thread, so the publisher is only used under send_lock.
+        with self.send_lock:
+            self.publisher.wait_for_unsubscribed(self._DEVICES)
         self._logger_shutdown()
         self.running = False
 
@@ -138,6 +149,9 @@ class WormTrackerHub(Hub):
     def _teensy_commands_movez(self, zvel):
         self.send("teensy_commands movez {}".format(zvel))
 
+    def _teensy_commands_move_xyz(self, xvel, yvel, zvel):
+        self.send("teensy_commands move_xyz {} {} {}".format(xvel, yvel, zvel))
+
     def _teensy_commands_disable(self):
         self.send("teensy_commands disable")
     
@@ -153,7 +167,8 @@ def main():
         outbound=parse_host_and_port(arguments["--outbound"]),
         server=int(arguments["--server"]),
         framerate=int(arguments["--framerate"]),
-        name=arguments["--name"])
+        name=arguments["--name"],
+        concurrent=arguments["--concurrent"])
 
     scope.run()
 
@@ -11,22 +11,108 @@ Options:
                                     [default: localhost:5000]
     --port=<PORT>               USB port.
                                     [default: COM4]
+    --heartbeat=SECONDS         Send a heartbeat to the hub this often.
+    --timeout=SECONDS           Time to wait for a reply from the board.
+                                    [default: 0.5]
 """
 
 import json
 import time
-from typing import Tuple
+import threading
+from collections import OrderedDict
+from typing import Iterable, Tuple
 
 import numpy as np
 from serial import Serial
 from docopt import docopt
 
 from wormtracker_scope.zmq.publisher import Publisher
+from wormtracker_scope.zmq.heartbeat import Heartbeat
 from wormtracker_scope.zmq.subscriber import ObjectSubscriber
-from wormtracker_scope.zmq.utils import parse_host_and_port
+from wormtracker_scope.zmq.utils import parse_host_and_port, LANE_OFFSETS
+
+class SerialLink(threading.Thread):
+    """This thread owns the serial port. Commands are queued with send and
+    written one at a time; after each, the thread waits for the position
+    reply of the board, with the timeout of the port, and publishes it to
+    the logger with its own publisher.
+
+    A queued command is replaced when a command with the same key, or one
+    it supersedes, is sent before it is written, so only the newest
+    velocity of each axis goes out."""
+
+    def __init__(self, serial_obj, outbound: Tuple[str, int, bool]):
+
+        threading.Thread.__init__(self, daemon=True)
+
+        self.serial_obj = serial_obj
+        self.outbound = outbound
+        self.queue = OrderedDict()
+        self.condition = threading.Condition()
+        self.running = True
+        self.count = 0
+        self.position = None
+
+    def send(self, key: str, command: bytes, supersedes: Iterable[str] = ()):
+        """Queue a command, replacing queued commands with the same key or
+        with keys in supersedes. Commands with a key of None are always
+        kept."""
+
+        with self.condition:
+            if key is None:
+                key = self.count
+                self.count += 1
+
+            for old_key in supersedes:
+                self.queue.pop(old_key, None)
+
+            self.queue[key] = command
+            self.queue.move_to_end(key)
+            self.condition.notify()
+
+    def stop(self):
+        """Write the queued commands, then end the thread."""
+
+        with self.condition:
+            self.running = False
+            self.condition.notify()
+        self.join()
+
+    def run(self):
+
+        publisher = Publisher(
+            host=self.outbound[0],
+            port=self.outbound[1],
+            bound=self.outbound[2])
+
+        while True:
+            with self.condition:
+                while self.running and not self.queue:
+                    self.condition.wait()
+                if not self.queue:
+                    break
+                (_, command) = self.queue.popitem(last=False)
+
+            self.serial_obj.write(command)
+            reply = self.serial_obj.readline()
+
+            if not reply.endswith(b"\n"):
+                print("No reply from the board to {}".format(command))
+                continue
+
+            try:
+                self.position = [int(coord) for coord in reply.split()]
+            except ValueError:
+                print("Unexpected reply from the board: {}".format(reply))
+                continue
+
+            publisher.send("logger " + json.dumps({"position": self.position}))
+
+        publisher.socket.close()
 
 class TeensyCommandsDevice():
-    """This device sends serial commands to the teensy board."""
+    """This device sends serial commands to the teensy board through a
+    SerialLink, so handling a command never waits for the board."""
 
 
     _COMMANDS = {
@@ -35,16 +121,27 @@ class TeensyCommandsDevice():
         "vx":"vx{xvel}\n",
         "vy":"vy{yvel}\n",
         "vz":"vz{zvel}\n",
+        "vxyz":"V{xvel} {yvel} {zvel}\n",
         "disable":"q\n",
         "enable":"e\n"
         }
 
+    # Velocity commands replace queued velocities of the same axes.
+    _SUPERSEDES = {
+        "vx": ("vx",),
+        "vy": ("vy",),
+        "vz": ("vz",),
+        "vxyz": ("vx", "vy", "vz", "vxyz")
+        }
+
     def __init__(
             self,
             inbound: Tuple[str, int, bool],
             outbound: Tuple[str, int, bool],
             port,
-            name="teensy_commands",):
+            name="teensy_commands",
+            heartbeat=None,
+            timeout=0.5):
 
         self.status = {}
         self.port = port
@@ -58,36 +155,45 @@ class TeensyCommandsDevice():
             name=name,
             host=inbound[0],
             port=inbound[1],
-            bound=inbound[2])
+            bound=inbound[2],
+            # Commands to this device are routed on the realtime lane; bulk
+            # only carries those from tools that do not route by lane.
+            lanes=LANE_OFFSETS)
 
         self.status_publisher = Publisher(
             host=outbound[0],
             port=outbound[1],
             bound=outbound[2])
 
+        self.heartbeat = Heartbeat(self.status_publisher, name, heartbeat)
+
         try:
-            self.serial_obj = Serial(port=self.port, baudrate=115200, timeout=0)
+            self.serial_obj = Serial(port=self.port, baudrate=115200, timeout=timeout)
             self.is_port_open = self.serial_obj.is_open
         except Exception as e:
             print (e)
             return
 
+        self.link = SerialLink(self.serial_obj, outbound)
+        self.link.start()
+
         self.enable()
 
-    def set_led(self, led_status):
+    def set_led(self, led_status: int):
         self._execute("set_led", led_status=led_status)
 
-    def movex(self, xvel):
+    def movex(self, xvel: float):
         self._execute("vx", xvel=xvel)
 
-    def movey(self, yvel):
+    def movey(self, yvel: float):
         self._execute("vy", yvel=yvel)
 
-    def movez(self, zvel):
+    def movez(self, zvel: float):
         self._execute("vz", zvel=zvel)
 
-    def update_position(self):
-        self.status_publisher.send("logger "+ json.dumps({"position": [self.x, self.y, self.z]}, default=int))
+    def move_xyz(self, xvel: float, yvel: float, zvel: float):
+        """Set the velocities of all three axes in one serial exchange."""
+        self._execute("vxyz", xvel=xvel, yvel=yvel, zvel=zvel)
 
     def disable(self):
         self._execute("disable")
@@ -95,40 +201,40 @@ class TeensyCommandsDevice():
     def enable(self):
         self._execute("enable")
 
-    def set_laser(self, laser_status):
+    def set_laser(self, laser_status: int):
         self._execute("set_laser", laser_status=laser_status)
 
-    def change_vel_z(self, sign):
+    def change_vel_z(self, sign: int):
         self.zspeed = int(np.clip(self.zspeed * 2 ** sign, 1, 1024))
         print("zspeed is: {}".format(self.zspeed))
 
-    def start_z_move(self, sign):
+    def start_z_move(self, sign: int):
         self.movez(sign * self.zspeed)
 
     def shutdown(self):
         self.device_status = 0
         self.set_led(0)
         self.disable()
+        self.link.stop()
         self.serial_obj.close()
         self.serial_obj.__del__()
 
     def _execute(self, cmd: str, **kwargs):
         cmd_format_string = self._COMMANDS[cmd]
         formatted_string = cmd_format_string.format(**kwargs)
-        reply = b''
-        self.serial_obj.write(bytes(formatted_string, "ascii"))
-        while not reply:
-            reply = self.serial_obj.readline()
-        pos = reply.decode("utf-8")[:-1].split(" ")
-        self.x, self.y, self.z = [int(coord) for coord in pos]
-        self.update_position()
+        supersedes = self._SUPERSEDES.get(cmd)
+        self.link.send(cmd if supersedes else None,
+                       bytes(formatted_string, "ascii"),
+                       supersedes or ())
 
     def run(self):
         """Starts a loop and receives and processes a message."""
         self.command_subscriber.flush()
         while self.device_status:
-            req = self.command_subscriber.recv()
-            self.command_subscriber.process(req)
+            if self.command_subscriber.socket.poll(self.heartbeat.poll_timeout()):
+                req = self.command_subscriber.recv()
+                self.command_subscriber.process(req)
+            self.heartbeat.tick()
 
 
 
@@ -141,7 +247,9 @@ def main():
     device = TeensyCommandsDevice(
         inbound=parse_host_and_port(arguments["--inbound"]),
         outbound=parse_host_and_port(arguments["--outbound"]),
-        port=arguments["--port"])
+        port=arguments["--port"],
+        heartbeat=arguments["--heartbeat"] and float(arguments["--heartbeat"]),
+        timeout=float(arguments["--timeout"]))
 
     if device is not None:
         device.run()
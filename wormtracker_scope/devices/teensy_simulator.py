@@ -0,0 +1,227 @@
+#! python
+#
+# Copyright 2022
+# Author: Mahdi Torkashvand
+
+"""
+This simulates the teensy board on a pseudo terminal, so that
+teensy_commands can run without the hardware. It speaks the protocol of
+TeensyController.ino and integrates the stepper positions from the
+commanded velocities.
+
+Usage:
+    teensy_simulator.py             [options]
+
+Options:
+    -h --help                       Show this help.
+    --latency=SECONDS               Time the board takes to reply.
+                                        [default: 0.0]
+    --link=PATH                     Also make the port available at PATH,
+                                        e.g. /tmp/teensy.
+    --benchmark=N                   Send N commands to the simulator,
+                                        report the throughput and reply
+                                        latency, and exit.
+"""
+
+import os
+import time
+import tty
+import select
+import threading
+from collections import deque
+
+import numpy as np
+from docopt import docopt
+
+COM_BUF_SIZE = 64
+MAX_SPEED = 1024.0
+
+# Stepper limits of the board, in steps: (low, high) for x, y and z.
+LIMITS = ((-25000, 18000), (-18000, 18000), (0, 10000))
+
+class TeensySimulator():
+    """This answers teensy commands written to a pseudo terminal, whose
+    path is self.port, with the positions of the three steppers. The last
+    commands received are kept in self.history."""
+
+    def __init__(self, latency=0.0, link=None):
+
+        self.latency = latency
+        self.link = link
+
+        self.position = [0.0, 0.0, 0.0]
+        self.speed = [0.0, 0.0, 0.0]
+        self.led = 0
+        self.laser = 0
+        self.enabled = 0
+        self.last_update = time.monotonic()
+
+        self.running = False
+        self.replies = 0
+        self.history = deque(maxlen=1000)
+
+        (self.master, self.slave) = os.openpty()
+        tty.setraw(self.slave)
+        self.port = os.ttyname(self.slave)
+
+        if self.link is not None:
+            if os.path.lexists(self.link):
+                os.remove(self.link)
+            os.symlink(self.port, self.link)
+
+    def update(self):
+        """Move the steppers to where they are now, stopping each at its
+        limits as the board does."""
+
+        now = time.monotonic()
+        dt = now - self.last_update
+        self.last_update = now
+
+        for axis in range(3):
+            (low, high) = LIMITS[axis]
+            pos = self.position[axis] + self.speed[axis] * dt
+            if (pos > high and self.speed[axis] > 0) or \
+                    (pos < low and self.speed[axis] < 0):
+                pos = float(np.clip(pos, low, high))
+                self.speed[axis] = 0.0
+            self.position[axis] = pos
+
+    def set_speed(self, axis: int, speed: float):
+        self.speed[axis] = float(np.clip(speed, -MAX_SPEED, MAX_SPEED))
+
+    def home(self):
+        """Run the steppers back to zero at full speed, blocking like the
+        board, and stop them."""
+
+        time.sleep(max(abs(pos) for pos in self.position) / MAX_SPEED)
+        self.position = [0.0, 0.0, 0.0]
+        self.speed = [0.0, 0.0, 0.0]
+        self.enabled = 0
+
+    def execute(self, line: bytes) -> bytes:
+        """Apply one command line and return the reply of the board."""
+
+        self.update()
+        self.history.append(line)
+
+        try:
+            if line[:1] == b"l":
+                self.led = int(line[1:2])
+            elif line[:1] == b"L":
+                self.laser = int(line[1:2])
+            elif line[:1] == b"v" and line[1:2] in (b"x", b"y", b"z"):
+                self.set_speed(b"xyz".index(line[1:2]), float(line[2:]))
+            elif line[:1] == b"V":
+                for (axis, speed) in enumerate(line[1:].split()[:3]):
+                    self.set_speed(axis, float(speed))
+            elif line[:1] == b"q":
+                self.home()
+            elif line[:1] == b"e":
+                self.position = [0.0, 0.0, 0.0]
+                self.speed = [0.0, 0.0, 0.0]
+                self.enabled = 1
+        except ValueError:
+            # atof on the board reads garbage as 0.
+            pass
+
+        return "{} {} {}\n".format(
+            *[int(pos) for pos in self.position]).encode("ascii")
+
+    def run(self):
+        """Answer commands until shutdown is called."""
+
+        self.running = True
+        buffer = b""
+
+        while self.running:
+            (readable, _, _) = select.select([self.master], [], [], 0.1)
+            if not readable:
+                continue
+
+            try:
+                buffer += os.read(self.master, 4096)
+            except OSError:
+                break
+
+            while b"\n" in buffer:
+                (line, buffer) = buffer.split(b"\n", 1)
+                if len(line) >= COM_BUF_SIZE:
+                    # The board drops commands that overflow its buffer.
+                    continue
+                reply = self.execute(line)
+                if self.latency:
+                    time.sleep(self.latency)
+                os.write(self.master, reply)
+                self.replies += 1
+
+            if len(buffer) >= COM_BUF_SIZE:
+                buffer = b""
+
+    def shutdown(self):
+        self.running = False
+
+    def close(self):
+        os.close(self.master)
+        os.close(self.slave)
+        if self.link is not None and os.path.islink(self.link):
+            os.remove(self.link)
+
+def benchmark(simulator: TeensySimulator, n: int):
+    """Send n velocity commands one at a time, as TeensyCommandsDevice
+    does, and print the throughput and the reply latency."""
+
+    from serial import Serial
+
+    serial_obj = Serial(port=simulator.port, baudrate=115200, timeout=1.0)
+    latencies = np.zeros(n)
+
+    serial_obj.write(b"e\n")
+    serial_obj.readline()
+
+    t0 = time.perf_counter()
+    for i in range(n):
+        command = "V{} {} {}\n".format(i % 200 - 100, 100 - i % 200, 0)
+        t = time.perf_counter()
+        serial_obj.write(command.encode("ascii"))
+        if not serial_obj.readline().endswith(b"\n"):
+            print("No reply to command {}".format(i))
+        latencies[i] = time.perf_counter() - t
+    elapsed = time.perf_counter() - t0
+
+    serial_obj.close()
+
+    latencies *= 1e6
+    print("{} commands in {:.3f} s: {:.0f} commands/s".format(
+        n, elapsed, n / elapsed))
+    print("reply latency us: mean {:.0f}, p50 {:.0f}, p99 {:.0f}, max {:.0f}".format(
+        latencies.mean(), *np.percentile(latencies, [50, 99, 100])))
+
+def main():
+    """CLI entry point."""
+    args = docopt(__doc__)
+
+    simulator = TeensySimulator(
+        latency=float(args["--latency"]),
+        link=args["--link"])
+
+    if args["--benchmark"] is not None:
+        thread = threading.Thread(target=simulator.run, daemon=True)
+        thread.start()
+        try:
+            benchmark(simulator, int(args["--benchmark"]))
+        finally:
+            simulator.shutdown()
+            thread.join()
+            simulator.close()
+        return
+
+    print("Simulating the teensy board on {}".format(simulator.link or simulator.port))
+    try:
+        simulator.run()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        simulator.close()
+
+if __name__ == "__main__":
+    main()
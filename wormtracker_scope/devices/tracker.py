@@ -21,6 +21,27 @@ Options:
                                             [default: localhost:5005]
     --format=UINT8_YX_512_512        Size and type of image being sent.
                                             [default: UINT8_YX_512_512]
+    --heartbeat=SECONDS                 Send a heartbeat to the hub this often.
+    --focus_metric=NAME                 Focus metric for the autofocus: fft,
+                                            laplacian, tenengrad or brenner.
+                                            [default: fft]
+    --control=NAME                      Control law: direct moves the stage
+                                            toward the worm as last seen,
+                                            kalman toward where a constant
+                                            velocity model expects it when
+                                            the command takes effect, and
+                                            pid uses a PID controller.
+                                            [default: direct]
+    --pid=KP,KI,KD                      Gains of the pid control law.
+                                            [default: 1.0,0.0,0.0]
+    --latency=SECONDS                   Delay between sending a command and
+                                            the stage responding, used by
+                                            the kalman control law.
+                                            [default: 0.02]
+    --search_window=SCALE               Search for the worm in a window this
+                                            many times its size around its
+                                            last position, 0 to always search
+                                            the whole frame. [default: 3]
 """
 
 import pstats
@@ -34,10 +55,18 @@ import numpy as np
 from docopt import docopt
 
 from wormtracker_scope.zmq.array import TimestampedSubscriber, TimestampedPublisher
-from wormtracker_scope.zmq.publisher import Publisher
+from wormtracker_scope.zmq.publisher import RoutedPublisher
 from wormtracker_scope.zmq.subscriber import ObjectSubscriber
 from wormtracker_scope.zmq.utils import parse_host_and_port
+from wormtracker_scope.zmq.trace import add_stamp, LatencyCollector
+from wormtracker_scope.zmq.heartbeat import Heartbeat
 from wormtracker_scope.devices.utils import array_props_from_string
+from wormtracker_scope.devices.tracker_tools import (
+    LUTTransform,
+    KalmanTracker,
+    PIDController
+)
+from wormtracker_scope.devices.focus import FocusMetrics
 
 
 
@@ -45,6 +74,8 @@ class TrackerDevice():
     """This creates a device that subscribes to images from a camera
     and sends commands to the motors"""
 
+    CONTROL_LAWS = ("direct", "kalman", "pid")
+
     def __init__(
             self,
             commands_in: Tuple[str, int, bool],
@@ -52,7 +83,13 @@ class TrackerDevice():
             data_in: Tuple[str, int, bool],
             data_out: Tuple[str, int],
             fmt: str,
-            name="tracker"):
+            name="tracker",
+            heartbeat=None,
+            search_window=3.0,
+            focus_metric="fft",
+            control="direct",
+            latency=0.02,
+            pid=(1.0, 0.0, 0.0)):
 
         np.seterr(divide = 'ignore')
         self.status = {}
@@ -63,29 +100,60 @@ class TrackerDevice():
         (self.dtype, _, self.shape) = array_props_from_string(fmt)
         self.out = np.zeros(self.shape, dtype=self.dtype)
 
-        self.data = np.zeros(self.shape)
+        self.data = np.zeros(self.shape, dtype=self.dtype)
         self.crop_size = self.shape[0] / 3
         self.crop_size_flag = False
         self.mean_sharpness = 0
         # self.max_sharpness = 0
         self.sharpness = 0
+        if focus_metric not in FocusMetrics.METRICS:
+            raise ValueError("Unknown focus metric: {}".format(focus_metric))
+        self.focus = FocusMetrics()
+        self.focus_metric = focus_metric
+        if control not in self.CONTROL_LAWS:
+            raise ValueError("Unknown control law: {}".format(control))
+        self.control = control
+        self.command_latency = latency
+        self.kalman = KalmanTracker()
+        self.last_timestamp = None
+        self.pid = PIDController(
+            *pid,
+            SPx=self.shape[1] // 2,
+            SPy=self.shape[0] // 2,
+            camera_number=0,
+            dt=0.1,
+            limit=max(self.shape) // 2,
+            tau=0.05)
         self.threshold = 30
         self.counter = 0
         self.vz = 16
         self.deltax = 0
         self.deltay = 0
         self.bbox = [0, 0, self.shape[0], self.shape[1]]
+        self.search_window = search_window
+        self.window_step = 2
+        self.min_window = 64
+        self.target_found = False
+        self.masks = {}
+        self.buffers = {}
+        self.lut = LUTTransform(power=4)
         self.tracking = 0
+        self.processed = 0
+        self.latency = LatencyCollector()
+        self.status_interval = 1.0
+        self.status_time = 0.0
 
         self.ds_shape = self.data[::4, ::4].shape
 
         self.running = 1
 
-        self.command_publisher = Publisher(
+        self.command_publisher = RoutedPublisher(
             host=commands_out[0],
             port=commands_out[1],
             bound=commands_out[2])
-        
+
+        self.heartbeat = Heartbeat(self.command_publisher, name, heartbeat)
+
         self.data_publisher = TimestampedPublisher(
             host=self.data_out[0],
             port=self.data_out[1],
@@ -105,25 +173,42 @@ class TrackerDevice():
             port=self.data_in[1],
             bound=self.data_in[2],
             shape=self.shape,
-            datatype=self.dtype)
+            datatype=self.dtype,
+            latest=True)
 
         self.poller.register(self.command_subscriber.socket, zmq.POLLIN)
         self.poller.register(self.data_subscriber.socket, zmq.POLLIN)
 
-        time.sleep(1)
+        self.command_publisher.wait_for_subscribers(["hub", "logger"])
         self.publish_status()
 
-        self.mask = self.get_mask(self.data[::4, ::4].shape[0])
-
-    def get_mask(self, radius):
-
-        r = np.linspace(int((1-radius) / 2),
-                        int((1+radius) / 2), radius)
-
-        Y, X = np.meshgrid(r, r, indexing='ij')
+    def get_cached_mask(self, shape):
+        """Return the mask for an image shape, scaled to uint8, computing it
+        only once."""
+        if shape not in self.masks:
+            self.masks[shape] = (self.get_mask(shape) * 255).astype(np.uint8)
+        return self.masks[shape]
+
+    def get_buffers(self, shape):
+        """Return two preallocated preprocessing buffers for an image
+        shape."""
+        if shape not in self.buffers:
+            self.buffers[shape] = (np.empty(shape, dtype=np.uint8),
+                                   np.empty(shape, dtype=np.uint8))
+        return self.buffers[shape]
+
+    def get_mask(self, shape):
+
+        (ry, rx) = shape
+        y = np.linspace(int((1-ry) / 2),
+                        int((1+ry) / 2), ry)
+        x = np.linspace(int((1-rx) / 2),
+                        int((1+rx) / 2), rx)
+
+        Y, X = np.meshgrid(y, x, indexing='ij')
         
-        g = np.exp(-(Y**4)/(2.0 * radius**4)
-                   -(X**4)/(2.0 * radius**4))
+        g = np.exp(-(Y**4)/(2.0 * ry**4)
+                   -(X**4)/(2.0 * rx**4))
 
         return g / np.max(g)
 
@@ -132,29 +217,46 @@ class TrackerDevice():
         """This processes the incoming images and sends move commands to zaber."""
         msg = self.data_subscriber.get_last()
 
+        trace = None
+        timestamp = None
         if msg is not None:
+            timestamp = msg[0]
+            trace = self.data_subscriber.trace
+            if trace is not None:
+                add_stamp(trace, "tracker_start")
             self.data = msg[1]
+            self.processed += 1
+            if self.data.shape != self.shape:
+                self.update_shape(self.data.shape)
 
 
         # t0 = time.time()
-        dsimg = np.invert(self.data[::4, ::4])
-        dsimg = cv2.medianBlur(dsimg, 3)
-        dsimg = np.multiply(dsimg, self.mask)
-        dsimg = dsimg.astype(np.float16) / max(dsimg.max(), 1)
-        dsimg = (dsimg ** 4 * 255).astype(np.uint8)
-        dsimg[dsimg<self.threshold]=0
-        contours, _ = cv2.findContours(dsimg, cv2.RETR_TREE, cv2.CHAIN_APPROX_SIMPLE)
-
-        if len(contours) >= 1:
-            max_size_idx = np.argmax([contour.shape[0] for contour in contours])
-            self.bbox = cv2.boundingRect(contours[max_size_idx])
-            self.bbox = [4 * i for i in self.bbox]
-
-
-        self.Dx= self.bbox[0] + self.bbox[2] // 2 - self.shape[1] // 2
-        self.Dy = self.bbox[1] + self.bbox[3] // 2 - self.shape[0] // 2
-        self.vx = np.sign(self.Dx) * int(((np.abs(self.Dx) * 2 / self.shape[1]) ** 0.7) * self.shape[1] / 2)
-        self.vy = np.sign(self.Dy) * int(((np.abs(self.Dy) * 2 / self.shape[0]) ** 0.7) * self.shape[0] / 2)
+        bbox = None
+        if self.search_window and self.target_found:
+            (y0, y1, x0, x1) = self.get_search_window()
+            bbox = self.find_bbox(self.data[y0:y1, x0:x1], self.window_step)
+            if bbox is not None:
+                bbox[0] += x0
+                bbox[1] += y0
+
+        if bbox is None:
+            bbox = self.find_bbox(self.data, 4)
+
+        self.target_found = bbox is not None
+        if bbox is not None:
+            self.bbox = bbox
+
+        (cx, cy) = self.get_target(timestamp)
+        self.Dx = cx - self.shape[1] // 2
+        self.Dy = cy - self.shape[0] // 2
+        if self.control == "pid":
+            if timestamp is not None:
+                (vx, vy) = self.pid.get_velocity(self.bbox,
+                                                 self.frame_interval(timestamp))
+                (self.vx, self.vy) = (-vx, -vy)
+        else:
+            self.vx = np.sign(self.Dx) * int(((np.abs(self.Dx) * 2 / self.shape[1]) ** 0.7) * self.shape[1] / 2)
+            self.vy = np.sign(self.Dy) * int(((np.abs(self.Dy) * 2 / self.shape[0]) ** 0.7) * self.shape[0] / 2)
         p1 = (self.bbox[0], self.bbox[1])
         p2 = (self.bbox[0] + self.bbox[2], self.bbox[1] + self.bbox[3])
 
@@ -168,11 +270,8 @@ class TrackerDevice():
 
         cropped_img = self.data[int(y_range[0]):int(y_range[1]), int(x_range[0]):int(x_range[1])]
 
-        try:
-            sharpness = self.calculate_sharpness(cropped_img)
-        except:
-            sharpness = 0
-        
+        sharpness = self.focus(cropped_img, self.focus_metric)
+
         self.mean_sharpness += (sharpness / 10)
 
         if self.counter % 5 == 0:
@@ -185,37 +284,146 @@ class TrackerDevice():
 
         # print(time.time() - t0)
 
+        if trace is not None:
+            add_stamp(trace, "tracker_end")
+
         annotated_img = self.data.copy()
         cv2.rectangle(annotated_img, p1, p2, (0, 0, 0), 2, 1)
 
-        self.data_publisher.send(annotated_img)
+        if trace is not None:
+            add_stamp(trace, "tracker_publish")
+
+        self.data_publisher.send(annotated_img, index=self.data_subscriber.index,
+                                 trace=trace)
         if self.tracking:
             if not self.crop_size_flag:
                 self.crop_size = max(self.bbox[2], self.bbox[3]) // 2
                 self.crop_size_flag=True
             
-            self.command_publisher.send("teensy_commands movey {}".format(-self.vy))
-            self.command_publisher.send("teensy_commands movex {}".format(-self.vx))
-            self.command_publisher.send("teensy_commands movez {}".format(self.vz))
+            self.command_publisher.send_command(
+                "teensy_commands", "move_xyz", -self.vx, -self.vy, self.vz)
         
+        if trace is not None:
+            add_stamp(trace, "tracker_commands")
+            self.latency.add(trace)
+
         self.counter += 1
 
+        if time.time() - self.status_time >= self.status_interval:
+            self.publish_status()
 
-    def calculate_sharpness(self, img, size=10):
-        (h, w) = img.shape
-        (cX, cY) = (int(w / 2), int(h / 2))
-        fft = np.fft.fft2(img)
-        fftShift = np.fft.fftshift(fft)
-        fftShift[cY - size:cY + size, cX - size:cX + size] = 0
-        fftShift = np.fft.ifftshift(fftShift)
-        recon = np.fft.ifft2(fftShift)
-        magnitude = 20 * np.log(np.abs(recon))
-        return np.mean(magnitude)
-        
 
+    def get_target(self, timestamp=None):
+        """Return the (x, y) position the stage should center, according
+        to the control law."""
+
+        cx = self.bbox[0] + self.bbox[2] // 2
+        cy = self.bbox[1] + self.bbox[3] // 2
+
+        if self.control != "kalman":
+            return (cx, cy)
+
+        if not self.target_found:
+            # Do not carry the last velocity forward while the worm is lost.
+            self.kalman.reset()
+            return (cx, cy)
+
+        if timestamp is not None:
+            self.kalman.update((cx, cy), timestamp)
+
+        now = time.time()
+        if self.kalman.is_stale(now):
+            self.kalman.reset()
+            return (cx, cy)
+
+        (px, py) = self.kalman.predict(now + self.command_latency,
+                                       max_dt=self.command_latency)
+        return (int(np.clip(px, 0, self.shape[1] - 1)),
+                int(np.clip(py, 0, self.shape[0] - 1)))
+
+    def frame_interval(self, timestamp):
+        """Return the time since the previous frame, or None for the first
+        one."""
+        dt = None
+        if self.last_timestamp is not None:
+            dt = timestamp - self.last_timestamp
+        self.last_timestamp = timestamp
+        return dt
+
+    def set_control(self, name: str):
+        """Select the control law, direct, kalman or pid."""
+        if name not in self.CONTROL_LAWS:
+            print("Unknown control law: {}".format(name))
+            return
+        self.control = name
+        self.kalman.reset()
+        self.pid.reset()
+        self.last_timestamp = None
+        self.publish_status()
+
+    def set_pid(self, kp: float, ki: float, kd: float):
+        """Change the gains of the pid control law."""
+        self.pid.set_gains(kp, ki, kd)
+        self.pid.reset()
+        self.publish_status()
+
+    def find_bbox(self, img, step):
+        """Return the bounding box [x, y, w, h] of the largest dark object
+        in img, searched at a resolution reduced by step, or None."""
+
+        dsimg = img[::step, ::step]
+        (buffer, dsimg_out) = self.get_buffers(dsimg.shape)
+
+        cv2.bitwise_not(dsimg, dst=buffer)
+        cv2.medianBlur(buffer, 3, dst=dsimg_out)
+        cv2.multiply(dsimg_out, self.get_cached_mask(dsimg.shape),
+                     dst=buffer, scale=1 / 255)
+        # Normalize, raise to the 4th power, and threshold in one table.
+        self.lut(buffer, threshold=self.threshold, out=dsimg_out)
+        contours, _ = cv2.findContours(dsimg_out, cv2.RETR_TREE, cv2.CHAIN_APPROX_SIMPLE)
+
+        if len(contours) == 0:
+            return None
+
+        max_size_idx = np.argmax([contour.shape[0] for contour in contours])
+        return [step * i for i in cv2.boundingRect(contours[max_size_idx])]
+
+    def get_search_window(self):
+        """Return (y0, y1, x0, x1) of a window search_window times the size
+        of the last bounding box, centered on it and moved inside the frame.
+        The size is rounded up to a multiple of min_window, so that few
+        masks and buffers are needed."""
+
+        (x, y, w, h) = self.bbox
+        size = max(int(max(w, h) * self.search_window), 1)
+        size = -(-size // self.min_window) * self.min_window
+        (cx, cy) = (x + w // 2, y + h // 2)
+
+        (size_y, size_x) = (min(size, self.shape[0]), min(size, self.shape[1]))
+        y0 = int(np.clip(cy - size_y // 2, 0, self.shape[0] - size_y))
+        x0 = int(np.clip(cx - size_x // 2, 0, self.shape[1] - size_x))
+
+        return (y0, y0 + size_y, x0, x0 + size_x)
+
+    def set_search_window(self, scale: float):
+        """Set the size of the search window relative to the worm, or turn
+        windowed search off with 0."""
+        self.search_window = scale
+        self.target_found = False
+        self.publish_status()
+
+    def set_focus_metric(self, name: str):
+        """Select the focus metric of the autofocus (see FocusMetrics)."""
+        if name not in FocusMetrics.METRICS:
+            print("Unknown focus metric: {}".format(name))
+            return
+        self.focus_metric = name
+        self.sharpness = 0
+        self.mean_sharpness = 0
+        self.publish_status()
 
 
-    def change_threshold(self, direction):
+    def change_threshold(self, direction: int):
         self.threshold = np.clip(self.threshold + direction, 0, 255)
 
         print("Threshold: {}".format(self.threshold))
@@ -224,41 +432,53 @@ class TrackerDevice():
     def toggle_tracking(self):
         if self.tracking:
             print("tracking stopped")
-            self.command_publisher.send("teensy_commands movey 0")
-            self.command_publisher.send("teensy_commands movex 0")
-            self.command_publisher.send("teensy_commands movez 0")
+            self.command_publisher.send_command(
+                "teensy_commands", "move_xyz", 0, 0, 0)
             self.tracking = 0
             self.crop_size_flag = False
         else:
+            self.pid.reset()
+            self.last_timestamp = None
             self.tracking = 1
             print("tracking started")
 
 
-    def set_shape(self, y ,x):
-        self.poller.unregister(self.data_subscriber.socket)
+    def set_shape(self, y: int, x: int):
+        """Frames carry their own shape, so this is only needed to change
+        the expected shape before the first frame arrives."""
+        self.data_subscriber.set_shape((y, x))
+        self.data_publisher.set_shape((y, x))
+        self.data = np.zeros((y, x), dtype=self.dtype)
+        self.update_shape((y, x))
 
-        self.shape = (y, x)
-        self.tracker.set_shape(y, x)
+    def update_shape(self, shape):
+        """Resize everything that depends on the image shape."""
+        self.shape = tuple(shape)
         self.out = np.zeros(self.shape, dtype=self.dtype)
-
-        self.data_subscriber.set_shape(self.shape)
-        self.data_publisher.set_shape(self.shape)
-
-        self.poller.register(self.data_subscriber.socket, zmq.POLLIN)
+        self.crop_size = self.shape[0] / 3
+        self.crop_size_flag = False
+        self.bbox = [0, 0, self.shape[0], self.shape[1]]
+        self.ds_shape = self.data[::4, ::4].shape
+        self.masks = {}
+        self.buffers = {}
+        self.pid.set_center(self.shape[1] // 2, self.shape[0] // 2)
+        self.pid.limit = self.pid.i_limit = max(self.shape) // 2
+        self.target_found = False
         self.publish_status()
 
     def stop(self):
         """Stops the subscription to data port."""
         if self.tracking:
             self.tracking = 0
-            self.command_publisher.send("zaber stop_xy")
+            self.command_publisher.send_command(
+                "teensy_commands", "move_xyz", 0, 0, 0)
             self.publish_status()
 
     def start(self):
         """Start subscribing to image data."""
         if not self.tracking:
-            self.pid.Ix = 0
-            self.pid.Iy = 0
+            self.pid.reset()
+            self.last_timestamp = None
             self.tracking = 1
             self.publish_status()
 
@@ -272,12 +492,25 @@ class TrackerDevice():
         """updates the status dictionary."""
         self.status["shape"] = self.shape
         self.status["tracking"] = self.tracking
+        self.status["search_window"] = self.search_window
+        self.status["focus"] = {
+            "metric": self.focus_metric,
+            "cost": self.focus.cost_summary()}
         self.status["device"] = self.running
+        self.status["frames"] = {
+            "received": self.data_subscriber.received,
+            "skipped": self.data_subscriber.dropped,
+            "processed": self.processed}
+        self.status["latency"] = self.latency.summary()
+        self.status["control"] = self.control
+        self.status["pid"] = [self.pid.Kp, self.pid.Ki, self.pid.Kd]
+        self.status["target_velocity"] = self.kalman.velocity
 
 
     def publish_status(self):
         """Publishes the status to the hub and logger."""
         self.update_status()
+        self.status_time = time.time()
         self.command_publisher.send("hub " + json.dumps({self.name: self.status}, default=int))
         self.command_publisher.send("logger " + json.dumps({self.name: self.status}, default=int))
 
@@ -287,7 +520,8 @@ class TrackerDevice():
 
         while self.running:
 
-            sockets = dict(self.poller.poll())
+            sockets = dict(self.poller.poll(self.heartbeat.poll_timeout()))
+            self.heartbeat.tick()
 
             if self.command_subscriber.socket in sockets:
                 self.command_subscriber.handle()
@@ -304,7 +538,13 @@ def main():
         data_in=parse_host_and_port(arguments["--data_in"]),
         commands_out=parse_host_and_port(arguments["--commands_out"]),
         data_out=parse_host_and_port(arguments["--data_out"]),
-        fmt=arguments["--format"])
+        fmt=arguments["--format"],
+        heartbeat=arguments["--heartbeat"] and float(arguments["--heartbeat"]),
+        search_window=float(arguments["--search_window"]),
+        focus_metric=arguments["--focus_metric"],
+        control=arguments["--control"],
+        latency=float(arguments["--latency"]),
+        pid=[float(gain) for gain in arguments["--pid"].split(",")])
 
     device.run()
 
@@ -6,6 +6,36 @@
 import cv2
 import numpy as np
 
+class LUTTransform():
+    """
+    This maps uint8 images through a lookup table computing
+    (x / maximum) ** power * 255, with results below threshold set to 0.
+    The table is rebuilt only when maximum or threshold change.
+    """
+    def __init__(self, power=4):
+        self.power = power
+        self.key = None
+        self.lut = np.zeros(256, dtype=np.uint8)
+
+    def build(self, maximum, threshold):
+        x = np.arange(256, dtype=np.float64) / max(maximum, 1)
+        lut = np.clip(x ** self.power * 255, 0, 255).astype(np.uint8)
+        lut[lut < threshold] = 0
+        self.lut[:] = lut
+
+    def __call__(self, img, maximum=None, threshold=0, out=None):
+        """Transform img into out, and return out. If maximum is None, the
+        maximum of img is used."""
+        if maximum is None:
+            maximum = int(img.max())
+
+        key = (int(maximum), int(threshold))
+        if key != self.key:
+            self.build(*key)
+            self.key = key
+
+        return cv2.LUT(img, self.lut, dst=out)
+
 class ObjectDetector():
     """
     an object detection class.
@@ -19,6 +49,8 @@ class ObjectDetector():
         self.y_slice = np.s_[self.shape[1] // 2 - self.crop_size // 2: self.shape[1] // 2 + self.crop_size // 2]
         self.x_slice = np.s_[self.shape[2] // 2 - self.crop_size // 2: self.shape[2] // 2 + self.crop_size // 2]
         self.bbox = (self.shape[2] // 2, self.shape[1] // 2, 10, 10)
+        self.lut = LUTTransform(power=3)
+        self.blurred = None
 
     def set_shape(self, z, y, x):
         self.shape = (z, y, x)
@@ -42,11 +74,15 @@ class ObjectDetector():
 
     def get_bbox(self, v):
         cropped_img = np.max(v, axis=0)[self.y_slice, self.x_slice]
-        blurred = cv2.medianBlur(cropped_img, 5)
-        blurred = blurred.astype(np.float32) / blurred.max()
-        blurred = (blurred ** 3 * 255).astype(np.uint8)
+        if self.blurred is None or self.blurred.shape != cropped_img.shape:
+            self.blurred = np.empty_like(cropped_img)
+        blurred = cv2.medianBlur(cropped_img, 5, dst=self.blurred)
+        blurred = self.lut(blurred, out=blurred)
         quantile = min(254, np.quantile(blurred, self.percentile))
-        blurred[blurred<quantile]=0
+        # Values not above the threshold are zeroed, so this zeroes values
+        # below the quantile.
+        cv2.threshold(blurred, np.ceil(quantile) - 1, 0, cv2.THRESH_TOZERO,
+                      dst=blurred)
         contours, _ = cv2.findContours(blurred, cv2.RETR_TREE,
                                        cv2.CHAIN_APPROX_SIMPLE)
         if len(contours) >= 1:
@@ -58,12 +94,91 @@ class ObjectDetector():
 
         self.out[self.y_slice, self.x_slice] = blurred
 
+class KalmanTracker():
+    """
+    This is a constant velocity Kalman filter over the position of a point
+    in the image. Measurements are made at the timestamps of the frames,
+    and the position can be predicted at any later time, such as when a
+    motor command takes effect. The filter restarts after a gap longer than
+    max_gap seconds.
+
+    q: variance of the acceleration in px^2/s^4
+    r: variance of the measured position in px^2
+    """
+    def __init__(self, q=1e5, r=4.0, max_gap=0.5):
+        self.q = q
+        self.r = r
+        self.max_gap = max_gap
+        self.H = np.array([[1, 0, 0, 0], [0, 1, 0, 0]], dtype=np.float64)
+        self.R = np.eye(2) * r
+        self.reset()
+
+    def reset(self):
+        self.x = None
+        self.P = None
+        self.t = None
+
+    def transition(self, dt):
+        F = np.eye(4)
+        F[0, 2] = F[1, 3] = dt
+        return F
+
+    def noise(self, dt):
+        Q = np.zeros((4, 4))
+        Q[0, 0] = Q[1, 1] = dt ** 4 / 4
+        Q[0, 2] = Q[2, 0] = Q[1, 3] = Q[3, 1] = dt ** 3 / 2
+        Q[2, 2] = Q[3, 3] = dt ** 2
+        return Q * self.q
+
+    def update(self, point, t):
+        """Add a measured position at time t (in seconds)."""
+        z = np.asarray(point, dtype=np.float64)
+
+        if self.x is None or not 0 < t - self.t <= self.max_gap:
+            self.x = np.array([z[0], z[1], 0.0, 0.0])
+            self.P = np.diag([self.r, self.r, 1e6, 1e6])
+            self.t = t
+            return
+
+        dt = t - self.t
+        F = self.transition(dt)
+        x = F @ self.x
+        P = F @ self.P @ F.T + self.noise(dt)
+
+        S = self.H @ P @ self.H.T + self.R
+        K = P @ self.H.T @ np.linalg.inv(S)
+        self.x = x + K @ (z - self.H @ x)
+        self.P = (np.eye(4) - K @ self.H) @ P
+        self.t = t
+
+    def predict(self, t, max_dt=None):
+        """Return the (x, y) position expected at time t, extrapolating at
+        most max_dt seconds past the last measurement."""
+        dt = t - self.t
+        if max_dt is not None:
+            dt = min(dt, max_dt)
+        return (self.x[0] + self.x[2] * dt, self.x[1] + self.x[3] * dt)
+
+    @property
+    def velocity(self):
+        return (0.0, 0.0) if self.x is None else (self.x[2], self.x[3])
+
+    def is_stale(self, t):
+        """Whether the last measurement is more than max_gap before t."""
+        return self.x is None or t - self.t > self.max_gap
+
 class PIDController():
     """
     This PID controller calculates the velocity based
-    on the current x,y value of the point of interest."""
+    on the current x,y value of the point of interest.
+
+    The output is limited to +-limit, and the integral to +-i_limit; the
+    integral also stops growing while the output is saturated in the
+    direction of the error. The derivative is low-pass filtered with time
+    constant tau. Camera number 0 leaves the axes as they are."""
 
-    def __init__(self, Kp, Ki, Kd, SPx, SPy, camera_number, dt):
+    def __init__(self, Kp, Ki, Kd, SPx, SPy, camera_number, dt,
+                 limit=None, i_limit=None, tau=0.0):
 
         self.Kp = Kp
         self.Ki = Ki
@@ -76,26 +191,58 @@ class PIDController():
         self.Ey = 0.0
 
         self.dt = dt
+        self.limit = limit
+        self.i_limit = limit if i_limit is None else i_limit
+        self.tau = tau
 
         self.Ix = 0.0
         self.Iy = 0.0
 
+        self.Dx = 0.0
+        self.Dy = 0.0
+
         self.axes_correction = np.array([[[1, 0], [0, -1]],
                                          [[0, 1], [1, 0]]])
 
-        self.converter = self.axes_correction[camera_number-1]
+        self.set_camera_number(camera_number)
 
     def set_rate(self, rate):
         self.dt = 1 / float(rate)
 
     def set_camera_number(self, camera_number):
-        self.converter = self.axes_correction[camera_number-1]
+        if camera_number == 0:
+            self.converter = np.eye(2, dtype=int)
+        else:
+            self.converter = self.axes_correction[camera_number-1]
+
+    def set_gains(self, Kp, Ki, Kd):
+        self.Kp = Kp
+        self.Ki = Ki
+        self.Kd = Kd
+
+    def reset(self):
+        self.Ex = 0.0
+        self.Ey = 0.0
+        self.Ix = 0.0
+        self.Iy = 0.0
+        self.Dx = 0.0
+        self.Dy = 0.0
+
+    def clip(self, value, limit):
+        if limit is None:
+            return value
+        return min(max(value, -limit), limit)
 
     def set_center(self, SPx, SPy):
         self.SPx = SPx
         self.SPy = SPy
 
-    def get_velocity(self, bbox):
+    def get_velocity(self, bbox, dt=None):
+        """Return the velocity for a bounding box measured dt seconds after
+        the previous one (by default the nominal interval)."""
+
+        if dt is None or dt <= 0:
+            dt = self.dt
 
         x = bbox[0] + bbox[2] // 2
         y = bbox[1] + bbox[3] // 2
@@ -103,19 +250,30 @@ class PIDController():
         Ex = self.SPx - x
         Ey = self.SPy - y
 
-        Px = self.Kp * Ex
-        Py = self.Kp * Ey
+        (Vx, self.Ix, self.Dx) = self.axis(Ex, self.Ex, self.Ix, self.Dx, dt)
+        (Vy, self.Iy, self.Dy) = self.axis(Ey, self.Ey, self.Iy, self.Dy, dt)
 
-        self.Ix = self.Ix + self.Ki * (Ex + self.Ex) * self.dt / 2
-        self.Iy = self.Iy + self.Ki * (Ey + self.Ey) * self.dt / 2
+        self.Ex = Ex
+        self.Ey = Ey
 
-        Dx = self.Kd * (Ex - self.Ex) / self.dt
-        Dy = self.Kd * (Ey - self.Ey) / self.dt
+        return np.matmul(self.converter, (Vx, Vy))
 
-        Vx = int(Px + self.Ix + Dx)
-        Vy = int(Py + self.Iy + Dy)
+    def axis(self, E, E_prev, I, D, dt):
+        """Return the output, integral and filtered derivative of one
+        axis."""
 
-        self.Ex = Ex
-        self.Ey = Ey
+        P = self.Kp * E
+
+        alpha = dt / (self.tau + dt)
+        D = D + alpha * (self.Kd * (E - E_prev) / dt - D)
+
+        I_next = self.clip(I + self.Ki * (E + E_prev) * dt / 2, self.i_limit)
+        V = P + I_next + D
+        V_limited = self.clip(V, self.limit)
+
+        if V != V_limited and (V > 0) == (E > 0):
+            V_limited = self.clip(P + I + D, self.limit)
+        else:
+            I = I_next
 
-        return np.matmul(self.converter, (Vx, Vy))
\ No newline at end of file
+        return (int(V_limited), I, D)
\ No newline at end of file
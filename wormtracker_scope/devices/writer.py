@@ -25,6 +25,7 @@ Options:
                                             [default: data]
     --name=NAME                         Device name.
                                             [default: writer]
+    --heartbeat=SECONDS                 Send a heartbeat to the hub this often.
 """
 
 from typing import Tuple
@@ -39,8 +40,10 @@ from wormtracker_scope.writers.array_writer import TimestampedArrayWriter
 from wormtracker_scope.zmq.array import TimestampedSubscriber
 from wormtracker_scope.zmq.subscriber import ObjectSubscriber
 from wormtracker_scope.zmq.publisher import Publisher
+from wormtracker_scope.zmq.heartbeat import Heartbeat
 from wormtracker_scope.devices.utils import make_timestamped_filename
 from wormtracker_scope.zmq.utils import parse_host_and_port
+from wormtracker_scope.zmq.trace import add_stamp, LatencyCollector
 from wormtracker_scope.devices.utils import array_props_from_string
 
 class  WriteSession(multiprocessing.Process):
@@ -54,7 +57,8 @@ class  WriteSession(multiprocessing.Process):
             fmt: str,
             directory: str,
             name="writer",
-            video_name="data"):
+            video_name="data",
+            heartbeat=None):
 
         multiprocessing.Process.__init__(self)
 
@@ -63,6 +67,10 @@ class  WriteSession(multiprocessing.Process):
         self.subscription_status = 0
         self.counter = 0
         self.max_frame_no = 200
+        self.processed = 0
+        self.latency = LatencyCollector()
+        self.status_interval = 1.0
+        self.status_time = 0.0
 
 
         self.name = name
@@ -79,6 +87,8 @@ class  WriteSession(multiprocessing.Process):
             port=status_out[1],
             bound=status_out[2])
 
+        self.heartbeat = Heartbeat(self.status_publisher, name, heartbeat)
+
         self.command_subscriber = ObjectSubscriber(
             obj=self,
             name=name,
@@ -97,7 +107,8 @@ class  WriteSession(multiprocessing.Process):
         self.poller.register(self.data_subscriber.socket, zmq.POLLIN)
 
     def set_shape(self, y, x):
-        """Updates the shape, closes the data subscriber, creates a new data subscriber"""
+        """Frames carry their own shape, so this is only needed to change
+        the expected shape before the first frame arrives."""
         self.shape = (y, x)
         self.poller.unregister(self.data_subscriber.socket)
         self.data_subscriber.set_shape(self.shape)
@@ -110,7 +121,9 @@ class  WriteSession(multiprocessing.Process):
 
             self.writer = TimestampedArrayWriter.from_source(self.data_subscriber,
                                                              self.filename)
+            self.segment = 0
             self.subscription_status = 1
+            self.publish_status()
             print("Recording Started.")
 
     def stop(self):
@@ -119,22 +132,25 @@ class  WriteSession(multiprocessing.Process):
             self.subscription_status = 0
             self.counter =0
             self.writer.close()
+            self.publish_status()
             print("Recording Ended.")
 
     def shutdown(self):
         """Close the hdf file and end while true loop of the poller"""
         self.stop()
         self.device_status = 0
+        self.publish_status()
 
     def run(self):
         """Start a while true loop with a poller that has command_subscriber already registered."""
 
         while self.device_status:
 
-            sockets = dict(self.poller.poll())
+            sockets = dict(self.poller.poll(self.heartbeat.poll_timeout()))
+            self.heartbeat.tick()
 
             if self.command_subscriber.socket in sockets:
-                _ = self.data_subscriber.get_last()
+                self.data_subscriber.discard()
                 self.command_subscriber.handle()
 
 
@@ -142,11 +158,54 @@ class  WriteSession(multiprocessing.Process):
                 if self.counter < self.max_frame_no :
 
                     if self.data_subscriber.socket in sockets:
-                        self.writer.save_frame()
-                        self.counter +=1
+                        self.save_frame()
                 else:
                     self.stop()
 
+    def save_frame(self):
+        """Write the most recent frame, starting a new segment of the file
+        if the shape or type of the frames has changed."""
+        msg = self.data_subscriber.get_last()
+        if msg is None:
+            return
+
+        if msg[1].shape != self.writer.shape or msg[1].dtype != self.writer.dtype:
+            self.writer.close()
+            self.segment += 1
+            self.writer = TimestampedArrayWriter.from_source(
+                self.data_subscriber, self.filename,
+                groupname="segment_{}".format(self.segment))
+
+        self.writer.append_data(msg)
+        self.counter +=1
+        self.processed += 1
+
+        trace = self.data_subscriber.trace
+        if trace is not None:
+            add_stamp(trace, "writer_flush")
+            self.latency.add(trace)
+
+        if time.time() - self.status_time >= self.status_interval:
+            self.publish_status()
+
+    def update_status(self):
+        """updates the status dictionary."""
+        self.status["shape"] = self.data_subscriber.shape
+        self.status["recording"] = self.subscription_status
+        self.status["device"] = self.device_status
+        self.status["frames"] = {
+            "received": self.data_subscriber.received,
+            "skipped": self.data_subscriber.dropped,
+            "processed": self.processed}
+        self.status["latency"] = self.latency.summary()
+
+    def publish_status(self):
+        """Publishes the status to the hub and logger."""
+        self.update_status()
+        self.status_time = time.time()
+        self.status_publisher.send("hub " + json.dumps({self.name: self.status}, default=int))
+        self.status_publisher.send("logger " + json.dumps({self.name: self.status}, default=int))
+
     def toggle(self) :
         if self.subscription_status :
             self.stop()
@@ -170,7 +229,8 @@ def main():
         fmt=args["--format"],
         directory=args["--directory"],
         name=args["--name"],
-        video_name=args["--video_name"])
+        video_name=args["--video_name"],
+        heartbeat=args["--heartbeat"] and float(args["--heartbeat"]))
 
     writer.run()
 
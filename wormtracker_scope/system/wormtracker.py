@@ -26,12 +26,25 @@ Options:
 import time
 import os
 import signal
+import tempfile
+from typing import Tuple
 from subprocess import Popen
 
+import zmq
 from docopt import docopt
 
 from wormtracker_scope.devices.utils import array_props_from_string
 
+def local_link(port: str) -> Tuple[str, str]:
+    """Return the addresses to bind and to connect to for a link between two
+    processes on this machine, using IPC instead of TCP where available."""
+
+    if zmq.has("ipc"):
+        path = os.path.join(tempfile.gettempdir(), "wormtracker_" + port)
+        return ("*ipc:" + path, "ipc:" + path)
+
+    return (port, "L" + port)
+
 def execute(job, fmt: str, camera_serial_number: str, binsize: str, exposure: str):
     """This runs all devices."""
 
@@ -41,13 +54,14 @@ def execute(job, fmt: str, camera_serial_number: str, binsize: str, exposure: st
     XInputToZMQPub_out = str(6000)
     processor_out = str(6001)
     data_camera_out = str(5003)
-    data_stamped = str(5004)
-    tracker_out = str(5005)
+    (data_stamped_out, data_stamped_in) = local_link(str(5004))
+    (tracker_out, tracker_in) = local_link(str(5005))
 
     (_, _, shape) = array_props_from_string(fmt)
     teensy_usb_port = "COM4"
     flir_exposure = exposure
     framerate = str(10)
+    heartbeat = str(0.1)
     binsize = str(binsize)
 
     data_directory = "C:\workspace\wormtracker\data\hdf_writer"
@@ -83,7 +97,8 @@ def execute(job, fmt: str, camera_serial_number: str, binsize: str, exposure: st
 
     job.append(Popen(["wormtracker_forwarder",
                       "--inbound=" + forwarder_in,
-                      "--outbound=" + forwarder_out]))
+                      "--outbound=" + forwarder_out,
+                      "--lanes=bulk,realtime"]))
 
     job.append(Popen(["FlirCamera",
                     "--serial_number=" + camera_serial_number,
@@ -101,21 +116,23 @@ def execute(job, fmt: str, camera_serial_number: str, binsize: str, exposure: st
                         "--data_in=L" + data_camera_out,
                         "--commands_in=L" + forwarder_out,
                         "--status_out=L" + forwarder_in,
-                        "--data_out=" + data_stamped,
+                        "--data_out=" + data_stamped_out,
                         "--format=" + fmt,
-                        "--name=data_hub"]))
+                        "--name=data_hub",
+                        "--heartbeat=" + heartbeat]))
 
     job.append(Popen(["wormtracker_writer",
-                        "--data_in=L" + data_stamped,
+                        "--data_in=" + data_stamped_in,
                         "--commands_in=L" + forwarder_out,
                         "--status_out=L" + forwarder_in,
                         "--format=" + fmt,
                         "--directory="+ data_directory,
                         "--video_name=flircamera",
-                        "--name=writer"]))
+                        "--name=writer",
+                        "--heartbeat=" + heartbeat]))
 
     job.append(Popen(["wormtracker_displayer",
-                          "--inbound=L" + tracker_out,
+                          "--inbound=" + tracker_in,
                           "--format=" + fmt,
                           "--commands=L" + forwarder_out,
                           "--name=displayer"]))
@@ -127,14 +144,16 @@ def execute(job, fmt: str, camera_serial_number: str, binsize: str, exposure: st
     job.append(Popen(["wormtracker_tracker",
                       "--commands_in=L" + forwarder_out,
                       "--commands_out=L" + forwarder_in,
-                      "--data_in=L" + data_stamped,
+                      "--data_in=" + data_stamped_in,
                       "--data_out=" + tracker_out,
-                      "--format=" + fmt]))
+                      "--format=" + fmt,
+                      "--heartbeat=" + heartbeat]))
 
     job.append(Popen(["wormtracker_teensy_commands",
                       "--inbound=L" + forwarder_out,
                       "--outbound=L" + forwarder_in,
-                      "--port=" + teensy_usb_port]))
+                      "--port=" + teensy_usb_port,
+                      "--heartbeat=" + heartbeat]))
 
 
 
@@ -158,8 +177,12 @@ def run(fmt: str, camera_serial_number: str, binsize: str, exposure: str):
 
     execute(jobs, fmt, camera_serial_number, binsize, exposure)
 
+    running = list(jobs)
     while True:
         time.sleep(1)
+        for job in [job for job in running if job.poll() is not None]:
+            print("{} exited with code {}".format(job.args[0], job.returncode))
+            running.remove(job)
 
 
 def main():
@@ -8,6 +8,7 @@
 #define N_ENABLE 6
 #define LED 21
 #define LASER 22
+#define COM_BUF_SIZE 64
 
 AccelStepper stepperX(AccelStepper::DRIVER,1,0);
 AccelStepper stepperY(AccelStepper::DRIVER,8,7);
@@ -74,7 +75,7 @@ void setup()
   setStepMode(1,5);
   setStepMode(2,5);
   
-  comBuf = (char*) malloc(24);
+  comBuf = (char*) malloc(COM_BUF_SIZE);
   nChar=0;
 }
 
@@ -84,7 +85,12 @@ void loop()
   {
     Serial.readBytes(comBuf+nChar, 1);
     nChar++;  
-    if (comBuf[nChar-1] == '\n')
+    if (nChar == COM_BUF_SIZE && comBuf[nChar-1] != '\n')
+    {
+      // Drop commands that do not fit in the buffer.
+      nChar = 0;
+    }
+    else if (comBuf[nChar-1] == '\n')
     {
       if (comBuf[0] == 'l')
       {
@@ -102,6 +108,17 @@ void loop()
         else if (comBuf[1] == 'y') stepperY.setSpeed(atof(comBuf+2));
         else if (comBuf[1] == 'z') stepperZ.setSpeed(atof(comBuf+2));
       }
+      else if (comBuf[0] == 'V')
+      {
+        // V<x speed> <y speed> <z speed>: set all three speeds at once.
+        char *end;
+        float vx = strtod(comBuf+1, &end);
+        float vy = strtod(end, &end);
+        float vz = strtod(end, &end);
+        stepperX.setSpeed(vx);
+        stepperY.setSpeed(vy);
+        stepperZ.setSpeed(vz);
+      }
       else if (comBuf[0] == 'q')
       {
         stepperX.setSpeed(1024);
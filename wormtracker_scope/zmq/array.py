@@ -3,18 +3,73 @@
 # Copyright 2021
 # Author: Mahdi Torkashvand, Vivek Venkatachalam
 
-"""This contains tools to send arrays of numbers between processes using TCP
-and ZeroMQ's Pub/Sub."""
-
-from typing import Tuple, Optional
+"""This contains tools to send arrays of numbers between processes using
+ZeroMQ's Pub/Sub.
+
+Arrays are sent without copying from the ndarray buffer, and received arrays
+are views over the ZMQ frame they arrived in. Timestamped arrays are sent as
+a two part message, (header, data), so that the array never has to be
+concatenated with or sliced from its metadata. Arrays handed to send should
+not be modified afterwards, and received arrays should be treated as
+read-only.
+
+The header describes the array it is sent with:
+
+    frame index     uint64
+    timestamp       float64, as returned by time.time()
+    dtype           4 bytes, numpy's dtype.str padded with zeros
+    ndim            uint8
+    shape           ndim * uint32
+
+so subscribers follow changes of shape or type without being told.
+
+Between processes on the same host, SharedMemoryPublisher and
+SharedMemorySubscriber move arrays through a ring of slots in shared memory
+instead, and only a (slot, sequence, timestamp) notification goes over
+ZMQ."""
+
+import os
+import re
+import time
+import struct
+import threading
+from typing import List, Tuple, Optional
+from multiprocessing import shared_memory, resource_tracker
 
 import zmq
+import zmq.asyncio
 import numpy as np
 
 from wormtracker_scope.zmq.utils import (
-    get_last,
-    push_timestamp,
-    pop_timestamp)
+    async_context,
+    address_from_host_and_port,
+    connect_or_bind,
+    get_last)
+
+_FRAME_INFO = struct.Struct("<Qd")
+_LAYOUT = struct.Struct("<4sB")
+
+_NOTIFICATION = struct.Struct("<IQd")
+_RING_SLOTS = struct.Struct("<I")
+_RING_HEADER_SIZE = 64
+_RING_ALIGNMENT = 64
+
+def pack_layout(dtype: np.dtype, shape: Tuple[int, ...]) -> bytes:
+    """Pack the type and shape of an array into the tail of a header."""
+
+    code = dtype.str.encode("ascii")
+    if len(code) > 4:
+        raise ValueError("Unsupported array type: {}".format(dtype))
+
+    return (_LAYOUT.pack(code, len(shape))
+            + struct.pack("<{}I".format(len(shape)), *shape))
+
+def unpack_layout(layout: bytes) -> Tuple[np.dtype, Tuple[int, ...]]:
+    """Unpack the type and shape of an array packed by pack_layout."""
+
+    (code, ndim) = _LAYOUT.unpack_from(layout)
+    shape = struct.unpack_from("<{}I".format(ndim), layout, _LAYOUT.size)
+    return (np.dtype(code.rstrip(b"\0").decode("ascii")), shape)
 
 class Publisher():
     """This publishes arrays over TCP using ZMQ."""
@@ -22,121 +77,660 @@ class Publisher():
     def __init__(
             self,
             host: str,
-            port: int,
+            port: Optional[int],
             shape: Tuple[int, ...],
             datatype: np.dtype,
             bound=False):
 
-        self.context = zmq.Context.instance()
+        self.context = self.get_context()
         self.socket = self.context.socket(zmq.PUB)
 
         self.bound = bound
-        address = "tcp://{}:{}".format(host, port)
-        if bound:
-            self.socket.bind(address)
-        else:
-            self.socket.connect(address)
+        self.address = address_from_host_and_port(host, port, bound)
+        connect_or_bind(self.socket, self.address, bound)
 
-        self.shape = shape
         self.dtype = np.dtype(datatype)
-        self.numel = np.prod(shape)
-        self.nbytes = self.numel * self.dtype.itemsize
+        self.set_shape(shape)
+
+    def get_context(self) -> zmq.Context:
+        """Return the context to create the socket in."""
+        return zmq.Context.instance()
 
     def set_shape(self, shape):
-        self.shape = shape
+        self.shape = tuple(shape)
         self.numel = np.prod(shape)
         self.nbytes = self.numel * self.dtype.itemsize
+        self.layout = pack_layout(self.dtype, self.shape)
 
     def send(self, data):
         """Publish an array."""
-        self.socket.send(data)
+        self.socket.send(np.ascontiguousarray(data), copy=False)
 
 class TimestampedPublisher(Publisher):
-    """This publishes arrays after appending timestamps as float64s."""
-
-    def send(self, data):
-        """Publish a time stamped array."""
-        data = push_timestamp(bytes(data))
-        self.socket.send(data)
+    """This publishes arrays in a message whose first frame is a header with
+    a frame index, a timestamp, and the type and shape of the array."""
+
+    def __init__(self, *args, **kwargs):
+        Publisher.__init__(self, *args, **kwargs)
+        self.index = 0
+
+    def send(self, data, index: Optional[int] = None,
+             trace: Optional[bytes] = None):
+        """Publish a time stamped array. By default frames are numbered in the
+        order they are sent, but index can be given to pass on the number of
+        a frame received from upstream. If trace is given it is sent as a
+        trailing frame (see wormtracker_scope.zmq.trace)."""
+
+        self.socket.send_multipart(self.pack_frames(data, index, trace),
+                                   copy=False)
+
+    def pack_frames(self, data, index: Optional[int] = None,
+                    trace: Optional[bytes] = None) -> list:
+        """Return the frames of the message to send for an array."""
+
+        if index is not None:
+            self.index = index
+
+        data = np.ascontiguousarray(data)
+        if data.shape != self.shape or data.dtype != self.dtype:
+            self.dtype = data.dtype
+            self.set_shape(data.shape)
+
+        header = _FRAME_INFO.pack(self.index, time.time()) + self.layout
+        self.index += 1
+
+        if trace is None:
+            return [header, data]
+
+        return [header, data, bytes(trace)]
+
+class LatestFrames(threading.Thread):
+    """This receives every message from a SUB socket as soon as it arrives
+    and keeps only the most recent one, so that messages never queue up at
+    the publisher for a slow consumer. Whenever a message is kept where none
+    was waiting, a token is sent to the receiver socket, which the consumer
+    polls; take returns the message and clears the tokens.
+
+    The thread owns source from then on, and closes it when stopped."""
+
+    def __init__(self, source: zmq.Socket, context: zmq.Context):
+
+        threading.Thread.__init__(self, daemon=True)
+
+        self.source = source
+        self.lock = threading.Lock()
+        self.frames = None
+        self.superseded = 0
+        self.running = True
+
+        address = "inproc://latest-frames-{}".format(id(self))
+        self.receiver = context.socket(zmq.PAIR)
+        self.receiver.bind(address)
+        self.tokens = zmq.Socket.shadow(self.receiver.underlying)
+        self.sender = zmq.Context.instance().socket(zmq.PAIR)
+        self.sender.connect(address)
+
+    def run(self):
+        # A synchronous view of source, which may be an asyncio socket.
+        socket = zmq.Socket.shadow(self.source.underlying)
+
+        while self.running:
+            if not socket.poll(100):
+                continue
+            frames = socket.recv_multipart(copy=False)
+            with self.lock:
+                if self.frames is None:
+                    self.sender.send(b"")
+                else:
+                    self.superseded += 1
+                self.frames = frames
+
+        self.source.close()
+        self.sender.close()
+
+    def take(self) -> Tuple[Optional[List[zmq.Frame]], int]:
+        """Return the most recent message, or None if it was already taken,
+        and the number of messages it superseded since the last take. The
+        receiver must not be read concurrently with this."""
+
+        with self.lock:
+            while True:
+                try:
+                    self.tokens.recv(flags=zmq.NOBLOCK)
+                except zmq.error.Again:
+                    break
+            (frames, self.frames) = (self.frames, None)
+            (superseded, self.superseded) = (self.superseded, 0)
+
+        return (frames, superseded)
+
+    def stop(self):
+        self.running = False
+        self.join()
 
 class Subscriber():
-    """This is a ZMQ subscriber that interprets messages as arrays."""
+    """This is a ZMQ subscriber that interprets messages as arrays.
+
+    With latest=True, a LatestFrames thread drains the SUB socket and keeps
+    only the most recent message, so that a slow consumer does not receive
+    frames it will throw away, and socket is replaced by the socket it
+    notifies, which can be polled as before. The number of messages
+    received is kept in received, and the number of frames that were
+    superseded before being returned is kept in dropped."""
 
     def __init__(
             self,
             host: str,
-            port: int,
+            port: Optional[int],
             shape: Tuple[int, ...],
             datatype: np.dtype,
-            bound=False):
+            bound=False,
+            latest=False):
 
-        self.context = zmq.Context.instance()
+        self.context = self.get_context()
         self.socket = self.context.socket(zmq.SUB)
 
+        self.latest = latest
+        self.received = 0
+        self.dropped = 0
+
         self.bound = bound
-        self.address = "tcp://{}:{}".format(host, port)
-        if self.bound:
-            self.socket.bind(self.address)
-        else:
-            self.socket.connect(self.address)
+        self.address = address_from_host_and_port(host, port, bound)
+        connect_or_bind(self.socket, self.address, bound)
 
         self.socket.setsockopt(zmq.SUBSCRIBE, b"")
 
-        self.shape = shape
-        self.dtype = np.dtype(datatype)
+        self.latest_frames = None
+        if self.latest:
+            self.latest_frames = LatestFrames(self.socket, self.context)
+            self.socket = self.latest_frames.receiver
+            self.latest_frames.start()
 
-        self.numel = np.prod(shape)
-        self.nbytes = self.numel * self.dtype.itemsize
+        self.dtype = np.dtype(datatype)
+        self.set_shape(shape)
 
     def set_shape(self, shape):
-        self.shape = shape
+        self.shape = tuple(shape)
         self.numel = np.prod(shape)
         self.nbytes = self.numel * self.dtype.itemsize
+        self.layout = pack_layout(self.dtype, self.shape)
+
+    def get_context(self) -> zmq.Context:
+        """Return the context to create the socket in."""
+        return zmq.Context.instance()
+
+    def close(self):
+        """Close the socket, and stop the thread draining it, if any."""
+
+        if self.latest_frames is not None:
+            self.latest_frames.stop()
+        self.socket.close()
+
+    def take_latest(self) -> List[zmq.Frame]:
+        """Return the message announced by a token just received in latest
+        mode, counting the messages it superseded as dropped."""
+
+        (frames, superseded) = self.latest_frames.take()
+        self.dropped += superseded
+        return frames
 
     def recv(self) -> np.ndarray:
         """ This will block until a message appears on the channel, and if
         multiple messages are present it will return them in order."""
-        buf = self.socket.recv()
-        return self.array_from_bytes(buf)
+        frame = self._recv_frame()
+        return self.array_from_bytes(frame.buffer)
 
     def get_last(self) -> Optional[np.ndarray]:
         """ This will return the most recent message present on the channel,
         and if no messages are present it will return None."""
-        buf = get_last(self.socket.recv)
+        received = self.received
+        frame = get_last(self._recv_frame)
 
-        if buf is None:
+        if frame is None:
             return None
 
-        return self.array_from_bytes(buf)
+        self.dropped += self.received - received - 1
+        return self.array_from_bytes(frame.buffer)
+
+    def discard(self):
+        """Throw away the messages present on the channel, counting them
+        as dropped."""
+        if self.get_last() is not None:
+            self.dropped += 1
+
+    def _recv_frame(self, flags=0) -> zmq.Frame:
+        """Receive a single frame message and count it."""
+        if self.latest_frames is None:
+            frame = self.socket.recv(flags=flags, copy=False)
+        else:
+            self.socket.recv(flags=flags)
+            frame = self.take_latest()[0]
+        self.received += 1
+        return frame
+
+    def array_from_bytes(self, buf: memoryview) -> np.ndarray:
+        """Interpret a buffer as an array without copying it."""
 
-    def array_from_bytes(self, buf: bytes) -> np.ndarray:
-        """Convert a message of bytes into an array."""
+        data = np.frombuffer(buf, self.dtype, count=self.numel)
+        return data.reshape(self.shape)
 
-        array_buf = buf[:self.nbytes]
-        data = np.frombuffer(array_buf, self.dtype)
-        shape = self.shape
-        shape_list = list(shape)
-        return data.reshape(shape_list)
+    def decode_header(self, header: bytes) -> Tuple[int, float]:
+        """Return the frame index and timestamp from a message header, and
+        adopt the type and shape it describes if they have changed."""
+
+        layout = header[_FRAME_INFO.size:]
+        if layout != self.layout:
+            (self.dtype, shape) = unpack_layout(layout)
+            self.set_shape(shape)
+
+        return _FRAME_INFO.unpack_from(header)
 
 class TimestampedSubscriber(Subscriber):
-    """This subscribes to arrays generated by a TimestampedPublisher."""
+    """This subscribes to arrays generated by a TimestampedPublisher. Frames
+    are counted as dropped from gaps in the frame index, so this includes
+    frames lost anywhere between the publisher and this subscriber, as well
+    as frames superseded in latest mode. The index and the trace, if any, of
+    the most recent frame are kept in index and trace."""
+
+    def __init__(self, *args, **kwargs):
+        Subscriber.__init__(self, *args, **kwargs)
+        self.index = None
+        self.trace = None
+
+    def take_latest(self) -> List[zmq.Frame]:
+        """Return the message announced by a token just received in latest
+        mode. Superseded frames are counted from gaps in the frame index,
+        except before the first frame, when there is no index to compare
+        with."""
+
+        (frames, superseded) = self.latest_frames.take()
+        if self.index is None:
+            self.dropped += superseded
+        return frames
 
     def recv(self) -> Tuple[float, np.ndarray]:
-        buf = self.socket.recv()
-        return self.unpack_buffer(buf)
+        frames = self._recv_frames()
+        return self.unpack_frames(frames)
 
     def get_last(self) -> Optional[Tuple[float, np.ndarray]]:
-        buf = get_last(self.socket.recv)
+        frames = get_last(self._recv_frames)
 
-        if buf is None:
+        if frames is None:
             return None
 
-        return self.unpack_buffer(buf)
+        return self.unpack_frames(frames)
 
-    def unpack_buffer(self, buf: bytes) -> Tuple[float, np.ndarray]:
-        """Convert a buffer containing an image and a timestamp into a tuple
-        with both."""
+    def _recv_frames(self, flags=0) -> List[zmq.Frame]:
+        """Receive a multipart message and count it."""
+        if self.latest_frames is None:
+            frames = self.socket.recv_multipart(flags=flags, copy=False)
+        else:
+            self.socket.recv(flags=flags)
+            frames = self.take_latest()
+        self.received += 1
+        return frames
+
+    def unpack_frames(self, frames: List[zmq.Frame]) -> Tuple[float, np.ndarray]:
+        """Convert the frames of a message containing a header and an image
+        into a tuple with the timestamp and the image."""
+
+        (index, timestamp) = self.decode_header(frames[0].bytes)
+        if self.index is not None and index > self.index + 1:
+            self.dropped += index - self.index - 1
+        self.index = index
+
+        if len(frames) > 2:
+            self.trace = bytearray(frames[2].bytes)
+        else:
+            self.trace = None
 
-        (timestamp, buf) = pop_timestamp(buf)
-        data = self.array_from_bytes(buf)
+        data = self.array_from_bytes(frames[1].buffer)
         return (timestamp, data)
+
+class AsyncPublisher(Publisher):
+    """This publishes arrays from asyncio coroutines."""
+
+    def get_context(self) -> zmq.asyncio.Context:
+        return async_context()
+
+    async def send(self, data):
+        """Publish an array."""
+        await self.socket.send(np.ascontiguousarray(data), copy=False)
+
+class AsyncTimestampedPublisher(TimestampedPublisher):
+    """This publishes timestamped arrays from asyncio coroutines."""
+
+    def get_context(self) -> zmq.asyncio.Context:
+        return async_context()
+
+    async def send(self, data, index: Optional[int] = None,
+                   trace: Optional[bytes] = None):
+        """Publish a time stamped array."""
+        await self.socket.send_multipart(self.pack_frames(data, index, trace),
+                                         copy=False)
+
+class AsyncSubscriber(Subscriber):
+    """This subscribes to arrays from asyncio coroutines."""
+
+    def get_context(self) -> zmq.asyncio.Context:
+        return async_context()
+
+    async def _recv_frame(self, flags=0) -> zmq.Frame:
+        """Receive a single frame message and count it."""
+        if self.latest_frames is None:
+            frame = await self.socket.recv(flags=flags, copy=False)
+        else:
+            await self.socket.recv(flags=flags)
+            frame = self.take_latest()[0]
+        self.received += 1
+        return frame
+
+    async def recv(self) -> np.ndarray:
+        """Wait for a message and return it as an array."""
+        frame = await self._recv_frame()
+        return self.array_from_bytes(frame.buffer)
+
+    async def get_last(self) -> Optional[np.ndarray]:
+        """Return the most recent array present on the channel, or None."""
+        frame = None
+
+        while True:
+            try:
+                newer = await self._recv_frame(flags=zmq.NOBLOCK)
+            except zmq.error.Again:
+                break
+            if frame is not None:
+                self.dropped += 1
+            frame = newer
+
+        if frame is None:
+            return None
+
+        return self.array_from_bytes(frame.buffer)
+
+class AsyncTimestampedSubscriber(TimestampedSubscriber):
+    """This subscribes to timestamped arrays from asyncio coroutines."""
+
+    def get_context(self) -> zmq.asyncio.Context:
+        return async_context()
+
+    async def _recv_frames(self, flags=0) -> List[zmq.Frame]:
+        """Receive a multipart message and count it."""
+        if self.latest_frames is None:
+            frames = await self.socket.recv_multipart(flags=flags, copy=False)
+        else:
+            await self.socket.recv(flags=flags)
+            frames = self.take_latest()
+        self.received += 1
+        return frames
+
+    async def recv(self) -> Tuple[float, np.ndarray]:
+        """Wait for a message and return its timestamp and array."""
+        frames = await self._recv_frames()
+        return self.unpack_frames(frames)
+
+    async def get_last(self) -> Optional[Tuple[float, np.ndarray]]:
+        """Return the timestamp and array of the most recent message present
+        on the channel, or None."""
+        frames = None
+
+        while True:
+            try:
+                frames = await self._recv_frames(flags=zmq.NOBLOCK)
+            except zmq.error.Again:
+                break
+
+        if frames is None:
+            return None
+
+        return self.unpack_frames(frames)
+
+def ring_name(host: str, port: Optional[int]) -> str:
+    """Return the default name of the shared memory ring announced on an
+    endpoint."""
+
+    if port is None:
+        return "wormtracker_" + re.sub(r"\W", "_", host)
+
+    return "wormtracker_{}".format(port)
+
+class SharedRing():
+    """This is a ring of preallocated array slots in shared memory. The
+    segment starts with a header describing the ring, followed by a sequence
+    number for every slot and then the slots themselves, each aligned to
+    _RING_ALIGNMENT bytes. A slot's sequence number is zero while it is being
+    written."""
+
+    def __init__(self, shm: shared_memory.SharedMemory, owner: bool):
+
+        self.shm = shm
+        self.owner = owner
+
+        (self.slots,) = _RING_SLOTS.unpack_from(shm.buf)
+        (self.dtype, self.shape) = unpack_layout(
+            bytes(shm.buf[_RING_SLOTS.size:_RING_HEADER_SIZE]))
+
+        (seq_offset, frame_offset, stride) = self._offsets(
+            self.slots, self.dtype, self.shape)
+
+        self.seqs = np.ndarray((self.slots,), np.uint64, shm.buf, seq_offset)
+        self.frames = np.ndarray(
+            (self.slots, *self.shape), self.dtype, shm.buf, frame_offset,
+            (stride, *np.empty(self.shape, self.dtype).strides))
+
+        if not owner:
+            self.frames.flags.writeable = False
+
+    @staticmethod
+    def _offsets(slots: int, dtype: np.dtype, shape: Tuple[int, ...]):
+        """Return the offsets of the sequence numbers and of the first slot,
+        and the distance between slots."""
+
+        def align(n):
+            return -(-n // _RING_ALIGNMENT) * _RING_ALIGNMENT
+
+        nbytes = int(np.prod(shape)) * dtype.itemsize
+        frame_offset = align(_RING_HEADER_SIZE + 8 * slots)
+        return (_RING_HEADER_SIZE, frame_offset, align(nbytes))
+
+    @classmethod
+    def create(cls, name: str, slots: int, dtype: np.dtype,
+               shape: Tuple[int, ...]) -> "SharedRing":
+        """Allocate a new ring, replacing a stale one with the same name."""
+
+        (_, frame_offset, stride) = cls._offsets(slots, dtype, shape)
+        size = frame_offset + slots * stride
+
+        try:
+            shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+        except FileExistsError:
+            stale = shared_memory.SharedMemory(name=name)
+            stale.close()
+            stale.unlink()
+            shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+
+        header = _RING_SLOTS.pack(slots) + pack_layout(dtype, shape)
+        if len(header) > _RING_HEADER_SIZE:
+            raise ValueError("Too many dimensions: {}".format(shape))
+        shm.buf[:len(header)] = header
+
+        ring = cls(shm, owner=True)
+        ring.seqs[:] = 0
+        return ring
+
+    @classmethod
+    def attach(cls, name: str) -> "SharedRing":
+        """Attach to a ring created by another process."""
+
+        try:
+            shm = shared_memory.SharedMemory(name=name, track=False)
+        except TypeError:
+            # Before python 3.13, attaching registers the segment with the
+            # resource tracker, which would unlink it when this process exits.
+            shm = shared_memory.SharedMemory(name=name)
+            if os.name == "posix":
+                resource_tracker.unregister(shm._name, "shared_memory")
+
+        return cls(shm, owner=False)
+
+    def write(self, slot: int, seq: int, data: np.ndarray):
+        """Copy data into a slot and mark it with seq."""
+        self.seqs[slot] = 0
+        np.copyto(self.frames[slot], data)
+        self.seqs[slot] = seq
+
+    def close(self):
+        """Release the views and the segment, removing it if this is the
+        process that created it."""
+        self.seqs = None
+        self.frames = None
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+class SharedMemoryPublisher():
+    """This publishes arrays through a SharedRing, sending only a small
+    (slot, sequence, timestamp) notification over ZMQ. This only works
+    between processes on the same host."""
+
+    def __init__(
+            self,
+            host: str,
+            port: Optional[int],
+            shape: Tuple[int, ...],
+            datatype: np.dtype,
+            bound=False,
+            name: Optional[str] = None,
+            slots: int = 8):
+
+        self.context = zmq.Context.instance()
+        self.socket = self.context.socket(zmq.PUB)
+
+        self.bound = bound
+        self.address = address_from_host_and_port(host, port, bound)
+        connect_or_bind(self.socket, self.address, bound)
+
+        if name is None:
+            name = ring_name(host, port)
+
+        self.name = name
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(datatype)
+        self.ring = SharedRing.create(name, slots, self.dtype, self.shape)
+        self.sequence = 0
+
+    def send(self, data):
+        """Copy an array into the next slot and announce it."""
+
+        if data.shape != self.shape:
+            raise ValueError("Expected an array of shape {}, got {}.".format(
+                self.shape, data.shape))
+        if data.dtype != self.dtype:
+            raise ValueError("Expected an array of type {}, got {}.".format(
+                self.dtype, data.dtype))
+
+        self.sequence += 1
+        slot = self.sequence % self.ring.slots
+        self.ring.write(slot, self.sequence, data)
+        self.socket.send(_NOTIFICATION.pack(slot, self.sequence, time.time()))
+
+    def close(self):
+        self.socket.close()
+        self.ring.close()
+
+class SharedMemorySubscriber():
+    """This subscribes to arrays published by a SharedMemoryPublisher. The
+    arrays returned are read-only views into the ring, so they are only
+    valid until the publisher wraps around to the same slot; is_valid
+    reports whether that has happened to the most recent array. Frames that
+    were overwritten before they were read, or never read at all, are
+    counted in dropped."""
+
+    def __init__(
+            self,
+            host: str,
+            port: Optional[int],
+            bound=False,
+            name: Optional[str] = None):
+
+        self.context = zmq.Context.instance()
+        self.socket = self.context.socket(zmq.SUB)
+
+        self.bound = bound
+        self.address = address_from_host_and_port(host, port, bound)
+        connect_or_bind(self.socket, self.address, bound)
+
+        self.socket.setsockopt(zmq.SUBSCRIBE, b"")
+
+        if name is None:
+            name = ring_name(host, port)
+
+        self.name = name
+        self.ring = None
+        self.slot = None
+        self.sequence = None
+        self.dropped = 0
+
+    @property
+    def shape(self) -> Optional[Tuple[int, ...]]:
+        return None if self.ring is None else self.ring.shape
+
+    @property
+    def dtype(self) -> Optional[np.dtype]:
+        return None if self.ring is None else self.ring.dtype
+
+    def recv(self) -> Tuple[float, np.ndarray]:
+        """Block until an array is announced that has not been overwritten
+        yet, and return it with its timestamp."""
+
+        while True:
+            result = self.unpack_notification(self.socket.recv())
+            if result is not None:
+                return result
+
+    def get_last(self) -> Optional[Tuple[float, np.ndarray]]:
+        """Return the most recently announced array with its timestamp, or
+        None if nothing new was announced."""
+
+        msg = get_last(self.socket.recv)
+
+        if msg is None:
+            return None
+
+        return self.unpack_notification(msg)
+
+    def unpack_notification(self, msg: bytes) -> Optional[Tuple[float, np.ndarray]]:
+        """Return the timestamp and array a notification refers to, or None
+        if the slot has already been overwritten."""
+
+        (slot, seq, timestamp) = _NOTIFICATION.unpack(msg)
+
+        if self.sequence is not None and seq <= self.sequence:
+            # The publisher has been restarted with a new ring.
+            self.ring.close()
+            self.ring = None
+            self.sequence = None
+
+        if self.ring is None:
+            self.ring = SharedRing.attach(self.name)
+
+        if self.sequence is not None:
+            self.dropped += seq - self.sequence - 1
+        self.sequence = seq
+
+        if self.ring.seqs[slot] != seq:
+            self.dropped += 1
+            return None
+
+        self.slot = slot
+        return (timestamp, self.ring.frames[slot])
+
+    def is_valid(self) -> bool:
+        """Whether the most recently returned array is still intact."""
+        return (self.slot is not None
+                and self.ring.seqs[self.slot] == self.sequence)
+
+    def close(self):
+        self.socket.close()
+        if self.ring is not None:
+            self.ring.close()
@@ -12,9 +12,21 @@ Usage:
 Options:
     -h --help             Show this help.
     --port=PORT           [default: 5002]
+    --timeout=SECONDS     Give up on replies after this long. This needs a
+                          server started with --concurrent.
+    --script=FILE         Send the requests in FILE, one per line, instead
+                          of reading them interactively ("-" for stdin).
+                          Blank lines and lines starting with # are skipped.
+                          This needs a server started with --concurrent.
+    --window=N            Number of requests in flight in script mode.
+                          [default: 8]
 """
 
+import sys
+import time
 import signal
+from collections import deque
+from typing import Iterable, List, Optional, Tuple
 
 import zmq
 from docopt import docopt
@@ -78,15 +90,217 @@ class Client():
         self.running = True
         self.loop()
 
+class PipelinedClient(Client):
+    """This is a client on a DEALER socket for a ConcurrentObjectServer. It
+    can have many requests in flight; each carries a request id, and replies
+    are matched to requests by id, whatever order they arrive in. Requests
+    that are not answered within their timeout are abandoned, and late
+    replies to them are discarded, so a lost reply does not wedge the
+    client the way it wedges a REQ socket."""
+
+    def __init__(
+            self,
+            port,
+            timeout=5.0,
+            host="localhost"):
+
+        self.port = port
+        self.timeout = timeout
+        self.running = False
+
+        self.next_id = 0
+        self.pending = {}
+        self.replies = {}
+
+        self.context = zmq.Context.instance()
+        self.socket = self.context.socket(zmq.DEALER)
+        self.socket.setsockopt(zmq.LINGER, 0)
+
+        address = "tcp://{}:{}".format(host, self.port)
+        self.socket.connect(address)
+
+    def send(self, req: bytes, timeout=None) -> int:
+        """Send a request and return its id."""
+
+        request_id = self.next_id
+        self.next_id += 1
+
+        if timeout is None:
+            timeout = self.timeout
+        sent = time.monotonic()
+        self.pending[request_id] = (sent, sent + timeout)
+
+        self.socket.send_multipart([b"", str(request_id).encode(), req])
+
+        return request_id
+
+    def poll(self, timeout=0.0) -> bool:
+        """Wait up to timeout seconds for a reply and store it. Return
+        whether a reply to a pending request was received."""
+
+        if not self.socket.poll(int(timeout * 1000)):
+            return False
+
+        (_, request_id, rep) = self.socket.recv_multipart()
+        request_id = int(request_id)
+
+        times = self.pending.pop(request_id, None)
+        if times is None:
+            return False
+
+        self.replies[request_id] = (rep, time.monotonic() - times[0])
+        return True
+
+    def poll_any(self):
+        """Wait for a reply to any pending request, or until the earliest
+        timeout passes."""
+
+        deadline = min(deadline for (_, deadline) in self.pending.values())
+        if not self.poll(max(deadline - time.monotonic(), 0.0)):
+            self.expire()
+
+    def expire(self):
+        """Abandon the requests whose timeout has passed and return their
+        ids."""
+
+        now = time.monotonic()
+        expired = [request_id
+                   for (request_id, (_, deadline)) in self.pending.items()
+                   if deadline <= now]
+
+        for request_id in expired:
+            del self.pending[request_id]
+
+        return expired
+
+    def recv(self, request_id=None) -> bytes:
+        """Wait for the reply to a request, by default the oldest pending
+        one. Raise TimeoutError if it does not arrive in time. The round
+        trip time of the request is kept in self.latency."""
+
+        if request_id is None:
+            request_id = min(self.pending.keys() | self.replies.keys())
+
+        while request_id not in self.replies:
+            times = self.pending.get(request_id)
+            if times is None:
+                raise TimeoutError("Request {} timed out.".format(request_id))
+
+            remaining = times[1] - time.monotonic()
+            if remaining <= 0:
+                self.expire()
+            else:
+                self.poll(remaining)
+
+        (rep, self.latency) = self.replies.pop(request_id)
+        return rep
+
+    def run_script(
+            self,
+            requests: Iterable[str],
+            window=8) -> List[Tuple[str, Optional[bytes], Optional[float]]]:
+        """Send requests while keeping up to window of them in flight, and
+        return (request, reply, round trip time in seconds) for each of them
+        in the order they were sent. The reply and the time are None for
+        requests that timed out. A ConcurrentObjectServer carries out the
+        requests of a client in order, so steps may depend on earlier ones."""
+
+        results = []
+        order = deque()
+
+        def collect():
+            while order and order[0][1] not in self.pending:
+                (req, request_id) = order.popleft()
+                (rep, latency) = self.replies.pop(request_id, (None, None))
+                results.append((req, rep, latency))
+
+        for req in requests:
+            while len(self.pending) >= window:
+                self.poll_any()
+                collect()
+
+            order.append((req, self.send(coerce_bytes(req))))
+
+        while self.pending:
+            self.poll_any()
+        collect()
+
+        return results
+
+    def process(self):
+        """Take a single request from stdin, send
+        it to a server, and print the reply."""
+
+        req_str = input()
+        if req_str == "DO shutdown":
+            self.running = False
+        request_id = self.send(coerce_bytes(req_str))
+
+        try:
+            print(coerce_string(self.recv(request_id)))
+        except TimeoutError as exc:
+            print(exc)
+
 def main():
     """CLI entry point."""
 
     args = docopt(__doc__)
     port = int(args["--port"])
 
-    client = Client(port)
+    if args["--script"] is not None:
+        run_script_file(args)
+        return
+
+    if args["--timeout"] is None:
+        client = Client(port)
+    else:
+        client = PipelinedClient(port, timeout=float(args["--timeout"]))
+
     client.run()
 
+def read_script(lines: Iterable[str]) -> List[str]:
+    """Return the requests in the lines of a script."""
+
+    requests = []
+    for line in lines:
+        line = line.strip()
+        if line and not line.startswith("#"):
+            requests.append(line)
+
+    return requests
+
+def run_script_file(args):
+    """Send the requests in a script and report the replies and latencies."""
+
+    client = PipelinedClient(
+        int(args["--port"]),
+        timeout=float(args["--timeout"] or 5.0))
+
+    if args["--script"] == "-":
+        requests = read_script(sys.stdin)
+    else:
+        with open(args["--script"]) as script:
+            requests = read_script(script)
+
+    t0 = time.monotonic()
+    results = client.run_script(requests, window=int(args["--window"]))
+    elapsed = time.monotonic() - t0
+
+    latencies = []
+    for (req, rep, latency) in results:
+        if rep is None:
+            print("   timeout  {}".format(req))
+        else:
+            latencies.append(latency)
+            print("{:7.1f} ms  {} -> {}".format(
+                latency * 1000, req, coerce_string(rep)))
+
+    print("{} requests in {:.3f} s, {} timed out".format(
+        len(results), elapsed, len(results) - len(latencies)))
+    if latencies:
+        print("latency: mean {:.1f} ms, max {:.1f} ms".format(
+            1000 * sum(latencies) / len(latencies), 1000 * max(latencies)))
+
 
 if __name__ == "__main__":
     main()
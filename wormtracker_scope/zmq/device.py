@@ -0,0 +1,89 @@
+#! python
+#
+# Copyright 2022
+# Author: Mahdi Torkashvand
+
+"""This contains a base class for devices built on asyncio, which handle
+commands and data in separate coroutines instead of a prioritized poller
+loop."""
+
+import abc
+import sys
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+class AsyncDevice(abc.ABC):
+    """This runs a command loop and a data loop concurrently.
+
+    Subclasses should create self.command_subscriber, an
+    AsyncObjectSubscriber for the device, and implement process, a coroutine
+    that waits for and handles one unit of data. Commands may be coroutine
+    methods; they are awaited by the command loop only, so the data loop
+    keeps running while a slow command is in progress. Blocking work, such
+    as serial I/O, file access, or heavy image processing, should be passed
+    to run_blocking so that it does not stall the event loop."""
+
+    def __init__(self, max_workers=1):
+
+        self.running = False
+        self.command_subscriber = None
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+
+    async def run_blocking(self, fn, *args):
+        """Run fn(*args) in the device's executor and return the result."""
+
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, fn, *args)
+
+    @abc.abstractmethod
+    async def process(self):
+        """Wait for and handle one unit of data."""
+
+    async def command_loop(self):
+        """Handle commands until the device stops."""
+
+        await self.command_subscriber.flush()
+        while self.running:
+            await self.command_subscriber.handle()
+
+    async def data_loop(self):
+        """Process data until the device stops."""
+
+        while self.running:
+            await self.process()
+
+    async def main(self):
+        """Run both loops until either of them returns."""
+
+        self.running = True
+
+        tasks = [asyncio.ensure_future(self.command_loop()),
+                 asyncio.ensure_future(self.data_loop())]
+
+        (done, pending) = await asyncio.wait(
+            tasks, return_when=asyncio.FIRST_COMPLETED)
+
+        self.running = False
+        for task in pending:
+            task.cancel()
+
+        for task in done:
+            task.result()
+
+    def run(self):
+        """Start the event loop and block until the device stops."""
+
+        if sys.platform == "win32":
+            # zmq.asyncio needs a selector event loop on Windows.
+            asyncio.set_event_loop_policy(
+                asyncio.WindowsSelectorEventLoopPolicy())
+
+        try:
+            asyncio.run(self.main())
+        finally:
+            self.executor.shutdown(wait=True)
+
+    def shutdown(self):
+        """Stop both loops."""
+
+        self.running = False
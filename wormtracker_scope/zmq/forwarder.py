@@ -11,40 +11,231 @@ Usage:
 
 Options:
     -h --help             Show this help.
-    --inbound=PORT        Binding for inbound messages.
+    --inbound=ADDRESS     Binding for inbound messages.
                           [default: 5000]
-    --outbound=PORT       Binding for outbound messages.
+    --outbound=ADDRESS    Binding for outbound messages.
                           [default: 5001]
+    --lanes=LANES         Comma separated lanes to forward, each on the
+                          addresses above shifted by the offset of the lane.
+                          [default: bulk,realtime]
+    --metrics             Count messages per topic and publish the rates on
+                          the metrics topic.
+    --interval=SECONDS    Time between metrics messages. [default: 1.0]
+    --window=SECONDS      Length of the sliding window rates are computed
+                          over. [default: 1.0]
+    --control=PORT        Serve "GET stats" requests on this port. This
+                          implies --metrics.
 """
 
+import json
 import signal
 import time
 import threading
 
+from typing import Dict, List, Optional, Tuple
+
 import zmq
 from docopt import docopt
 
-def run_proxy(inbound, outbound, context):
+from wormtracker_scope.zmq.server import ObjectServer
+from wormtracker_scope.zmq.utils import (
+    address_from_host_and_port,
+    parse_host_and_port,
+    connect_or_bind,
+    message_topic,
+    lane_address
+)
+
+CAPTURE_ADDRESS = "inproc://forwarder_capture"
+METRICS_ADDRESS = "inproc://forwarder_metrics"
+
+# Messages the capture socket of a proxy holds for a lagging BusMonitor
+# before it drops them.
+CAPTURE_HWM = 10000
+
+class TopicCounter():
+    """This counts the messages and bytes of one topic in a ring of time
+    buckets spanning a sliding window."""
+
+    def __init__(self, n_buckets):
+
+        self.messages = [0] * n_buckets
+        self.bytes = [0] * n_buckets
+        self.total_messages = 0
+        self.total_bytes = 0
+        self.bucket = 0
+
+    def advance(self, bucket: int):
+        """Clear the buckets that fell out of the window since the last
+        update."""
+
+        n_buckets = len(self.messages)
+        for i in range(self.bucket + 1, min(bucket, self.bucket + n_buckets) + 1):
+            self.messages[i % n_buckets] = 0
+            self.bytes[i % n_buckets] = 0
+        self.bucket = max(bucket, self.bucket)
+
+    def add(self, bucket: int, size: int):
+        """Count a message of size bytes."""
+
+        self.advance(bucket)
+        i = bucket % len(self.messages)
+        self.messages[i] += 1
+        self.bytes[i] += size
+        self.total_messages += 1
+        self.total_bytes += size
+
+class BusMonitor():
+    """This keeps per topic statistics of the messages copied to the capture
+    socket of the forwarder, and publishes them periodically on the metrics
+    topic. Rates are averaged over a sliding window; the peak burst is the
+    largest number of messages in one tenth of the window.
+
+    The capture sockets of the proxies drop messages rather than wait for
+    the monitor, so monitoring never slows down the bus, and under a burst
+    larger than the monitor can count the statistics are a lower bound."""
+
+    def __init__(
+            self,
+            context,
+            interval=1.0,
+            window=1.0,
+            n_buckets=10):
+
+        self.interval = interval
+        self.window = window
+        self.n_buckets = n_buckets
+        self.bucket_length = window / n_buckets
+        self.counters = {}
+        self.lock = threading.Lock()
+        self.running = False
+
+        self.capture = context.socket(zmq.SUB)
+        self.capture.setsockopt(zmq.RCVHWM, CAPTURE_HWM)
+        self.capture.setsockopt(zmq.SUBSCRIBE, b"")
+        self.capture.bind(CAPTURE_ADDRESS)
+
+        self.publisher = context.socket(zmq.PUB)
+        self.publisher.bind(METRICS_ADDRESS)
+
+    def add(self, frames: List[bytes], t: float):
+        """Count a captured message. Subscription messages from the
+        outbound side start with a zero or one byte and are ignored."""
+
+        if frames[0][:1] in (b"\0", b"\1"):
+            return
+
+        topic = message_topic(frames[0])
+        size = sum(len(frame) for frame in frames)
+
+        with self.lock:
+            if topic not in self.counters:
+                self.counters[topic] = TopicCounter(self.n_buckets)
+            self.counters[topic].add(int(t / self.bucket_length), size)
+
+    def summary(self) -> Dict[str, Dict[str, float]]:
+        """Return the message and byte rates, the peak burst, and the
+        totals of every topic."""
+
+        bucket = int(time.monotonic() / self.bucket_length)
+        summary = {}
+
+        with self.lock:
+            for (topic, counter) in self.counters.items():
+                counter.advance(bucket)
+                summary[topic] = {
+                    "messages_per_s": sum(counter.messages) / self.window,
+                    "bytes_per_s": sum(counter.bytes) / self.window,
+                    "peak_burst": max(counter.messages),
+                    "messages": counter.total_messages,
+                    "bytes": counter.total_bytes}
+
+        return summary
+
+    @property
+    def stats(self) -> str:
+        """The summary as JSON."""
+        return json.dumps(self.summary())
+
+    def reset(self):
+        """Clear all counters."""
+
+        with self.lock:
+            self.counters = {}
+
+    def run(self):
+        """Count captured messages and publish metrics until the context
+        is terminated."""
+
+        self.running = True
+        next_publish = time.monotonic() + self.interval
+
+        try:
+            while self.running:
+                timeout = max(next_publish - time.monotonic(), 0)
+                if self.capture.poll(int(timeout * 1000)):
+                    self.add(self.capture.recv_multipart(), time.monotonic())
+
+                if time.monotonic() >= next_publish:
+                    self.publisher.send_string("metrics " + self.stats)
+                    next_publish += self.interval
+
+        except zmq.ContextTerminated:
+            self.capture.close()
+            self.publisher.close()
+
+def run_proxy(
+        inbound: Tuple[str, Optional[int], bool],
+        outbound: Tuple[str, Optional[int], bool],
+        context,
+        capture=False,
+        metrics=True):
+    """Forward messages from inbound to outbound. With capture, every
+    message is also copied to the capture socket of a BusMonitor, which
+    has to be created first, and, with metrics, the metrics it publishes
+    are forwarded."""
 
     inbound_socket = context.socket(zmq.XSUB)
-    inbound_socket.bind("tcp://*:{}".format(inbound))
+    connect_or_bind(inbound_socket,
+                    address_from_host_and_port(*inbound),
+                    inbound[2])
 
     outbound_socket = context.socket(zmq.XPUB)
-    outbound_socket.bind("tcp://*:{}".format(outbound))
+    connect_or_bind(outbound_socket,
+                    address_from_host_and_port(*outbound),
+                    outbound[2])
+
+    capture_socket = None
+    if capture:
+        if metrics:
+            inbound_socket.connect(METRICS_ADDRESS)
+        capture_socket = context.socket(zmq.PUB)
+        capture_socket.setsockopt(zmq.SNDHWM, CAPTURE_HWM)
+        capture_socket.connect(CAPTURE_ADDRESS)
 
     try:
-        zmq.proxy(inbound_socket, outbound_socket)
+        zmq.proxy(inbound_socket, outbound_socket, capture_socket)
     except zmq.ContextTerminated:
         inbound_socket.close()
         outbound_socket.close()
+        if capture_socket is not None:
+            capture_socket.close()
+
+def serve(server):
+    """Run a server until the context is terminated."""
+
+    try:
+        server.run()
+    except zmq.ContextTerminated:
+        server.socket.close()
 
 def main():
     """CLI entry point."""
 
     args = docopt(__doc__)
 
-    inbound = int(args["--inbound"])
-    outbound = int(args["--outbound"])
+    inbound = parse_host_and_port(args["--inbound"])
+    outbound = parse_host_and_port(args["--outbound"])
 
     context = zmq.Context.instance()
 
@@ -54,11 +245,30 @@ def main():
 
     signal.signal(signal.SIGINT, _finish)
 
-    proxy_thread = threading.Thread(
-        target=run_proxy,
-        args=(inbound, outbound, context)
-    )
-    proxy_thread.start()
+    capture = args["--metrics"] or args["--control"] is not None
+
+    if capture:
+        monitor = BusMonitor(
+            context,
+            interval=float(args["--interval"]),
+            window=float(args["--window"]))
+        threading.Thread(target=monitor.run).start()
+
+        if args["--control"] is not None:
+            server = ObjectServer(port=int(args["--control"]), obj=monitor)
+            threading.Thread(target=serve, args=(server,)).start()
+
+    lanes = args["--lanes"].split(",")
+    for lane in lanes:
+        proxy_thread = threading.Thread(
+            target=run_proxy,
+            args=(lane_address(inbound, lane),
+                  lane_address(outbound, lane),
+                  context,
+                  capture,
+                  lane == lanes[0])
+        )
+        proxy_thread.start()
 
     while True:
         time.sleep(1000)
@@ -0,0 +1,126 @@
+#! python
+#
+# Copyright 2022
+# Author: Mahdi Torkashvand
+
+"""This contains tools for devices to report that they are alive, and for
+the hub to notice when they stop.
+
+A device calls Heartbeat.tick once per loop iteration, which costs a counter
+increment and a clock read. Every interval seconds it sends a beat to the
+hub as "hub heartbeat <name> <loop rate> <cpu> <max rss> <interval>", where
+cpu is the fraction of one core the device used since the last beat, and
+max rss is the peak resident memory in kB (0 where it is not available)."""
+
+import time
+import json
+from typing import Dict, List, Optional
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+def max_rss() -> int:
+    """Return the peak resident memory of this process in kB, or 0."""
+
+    if resource is None:
+        return 0
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+class Heartbeat():
+    """This sends a beat for a device every interval seconds. With an
+    interval of None it does nothing, so devices can always call tick."""
+
+    def __init__(self, publisher, name: str, interval: Optional[float] = None,
+                 topic="hub"):
+
+        self.publisher = publisher
+        self.name = name
+        self.interval = interval
+        self.topic = topic
+
+        self.iterations = 0
+        self.last_beat = time.monotonic()
+        self.next_beat = self.last_beat
+        self.last_cpu = time.process_time()
+
+    def poll_timeout(self) -> Optional[int]:
+        """Return the longest a device may block in poll, in ms, before
+        the next beat is due, or None if heartbeats are off."""
+
+        if self.interval is None:
+            return None
+        return max(int((self.next_beat - time.monotonic()) * 1000), 0)
+
+    def tick(self):
+        """Count a loop iteration and send a beat if one is due."""
+
+        if self.interval is None:
+            return
+
+        self.iterations += 1
+        now = time.monotonic()
+        if now >= self.next_beat:
+            self.beat(now)
+
+    def beat(self, now: float):
+        """Send a beat."""
+
+        cpu = time.process_time()
+        elapsed = max(now - self.last_beat, 1e-9)
+
+        self.publisher.send("{} heartbeat {} {:.2f} {:.3f} {} {}".format(
+            self.topic, self.name, self.iterations / elapsed,
+            (cpu - self.last_cpu) / elapsed, max_rss(), self.interval))
+
+        self.iterations = 0
+        self.last_beat = now
+        self.last_cpu = cpu
+        self.next_beat = now + self.interval
+
+class HeartbeatMonitor():
+    """This keeps the last beat of every device, and finds the devices whose
+    next beat is overdue by more than tolerance intervals."""
+
+    def __init__(self, tolerance=1.0):
+
+        self.tolerance = tolerance
+        self.beats = {}
+        self.deadlines = {}
+        self.missing = set()
+
+    def beat(self, device: str, stats: Dict[str, float], interval: float) -> bool:
+        """Record a beat and return whether the device was missing."""
+
+        now = time.monotonic()
+        self.beats[device] = dict(stats, interval=interval, time=time.time())
+        self.deadlines[device] = now + interval * (1 + self.tolerance)
+
+        revived = device in self.missing
+        self.missing.discard(device)
+
+        return revived
+
+    def next_deadline(self) -> Optional[float]:
+        """Return the time.monotonic() when the next beat may be missed."""
+
+        deadlines = [deadline for (device, deadline) in self.deadlines.items()
+                     if device not in self.missing]
+        return min(deadlines, default=None)
+
+    def check(self) -> List[str]:
+        """Return the devices that missed a beat since the last check."""
+
+        now = time.monotonic()
+        missed = [device for (device, deadline) in self.deadlines.items()
+                  if device not in self.missing and deadline < now]
+        self.missing.update(missed)
+
+        return missed
+
+    def __getitem__(self, device: str) -> Dict[str, float]:
+        return dict(self.beats[device], alive=device not in self.missing)
+
+    def __str__(self) -> str:
+        return json.dumps({device: self[device] for device in self.beats})
@@ -16,32 +16,128 @@ Options:
     --outbound=HOST:PORT  Connection for outbound messages.
                           [default: localhost:5000]
     --serve=PORT          Binding to serve on. [default: 5002]
+    --concurrent          Run DO requests on worker threads.
 """
 
-from typing import Tuple
+import time
+import json
+import threading
+from collections import deque
+from typing import Any, Dict, List, Tuple
 
 import zmq
 from docopt import docopt
 
 from wormtracker_scope.zmq.subscriber import ObjectSubscriber
-from wormtracker_scope.zmq.publisher import Publisher
-from wormtracker_scope.zmq.server import ObjectServer
+from wormtracker_scope.zmq.publisher import RoutedPublisher
+from wormtracker_scope.zmq.server import ObjectServer, ConcurrentObjectServer
+from wormtracker_scope.zmq.heartbeat import HeartbeatMonitor
 from wormtracker_scope.zmq.utils import parse_host_and_port
 
+class StatusRegistry():
+    """This keeps the latest status of every device, the time it was last
+    updated, and a bounded history of the changes. A device is stale if it
+    has not sent a status for stale_after seconds."""
+
+    def __init__(self, history=100, stale_after=5.0):
+
+        self.history_length = history
+        self.stale_after = stale_after
+
+        self.devices = {}
+        self.updated = {}
+        self.history = {}
+        self.stale = set()
+
+    def update(self, device: str, status: Dict[str, Any]) -> Dict[str, Any]:
+        """Merge a status into the one of device and return the entries that
+        changed."""
+
+        self.touch(device)
+        current = self.devices[device]
+
+        diff = {key: value for (key, value) in status.items()
+                if key not in current or current[key] != value}
+        current.update(diff)
+
+        if diff:
+            self.history[device].append((self.updated[device], diff))
+
+        return diff
+
+    def touch(self, device: str):
+        """Mark device as heard from without changing its status."""
+
+        if device not in self.devices:
+            self.devices[device] = {}
+            self.history[device] = deque(maxlen=self.history_length)
+
+        self.updated[device] = time.time()
+        self.stale.discard(device)
+
+    def age(self, device: str) -> float:
+        """Return the seconds since device last sent a status."""
+        return time.time() - self.updated[device]
+
+    def check_stale(self) -> List[str]:
+        """Return the devices that went stale since the last check."""
+
+        newly_stale = [device for device in self.devices
+                       if device not in self.stale
+                       and self.age(device) > self.stale_after]
+        self.stale.update(newly_stale)
+
+        return newly_stale
+
+    def __contains__(self, device: str) -> bool:
+        return device in self.devices
+
+    def __getitem__(self, device: str) -> Dict[str, Any]:
+        return {
+            "status": self.devices[device],
+            "updated": self.updated[device],
+            "age": self.age(device),
+            "stale": self.age(device) > self.stale_after,
+            "history": list(self.history[device])}
+
+    def __str__(self) -> str:
+        return json.dumps(
+            {device: {"status": status,
+                      "age": self.age(device),
+                      "stale": self.age(device) > self.stale_after}
+             for (device, status) in self.devices.items()},
+            default=str)
+
 class Hub():
     """This is a central hub that is responsible for subscribing and publishing
-    messages to system components, and handling requests from external clients."""
+    messages to system components, and handling requests from external clients.
+
+    Status messages of devices, {device: {key: value}}, are kept in
+    self.status, a StatusRegistry that clients can query with "GET status"
+    or "GET status <device>". Changes, and devices going stale, are
+    published as {device: {changed key: value}} on the status topic.
+
+    Devices with a Heartbeat send beats to the heartbeat method. A device
+    that misses a beat by more than one interval is published as
+    {device: {"alive": false}}, and beats can be queried with
+    "GET heartbeats <device>"."""
 
     def __init__(
             self,
             inbound: Tuple[str, int, bool],
             outbound: Tuple[str, int, bool],
             server_port: int,
-            name="hub"):
+            name="hub",
+            concurrent=False,
+            stale_after=5.0):
 
         self.name = name
+        self.send_lock = threading.Lock()
+        self.status = StatusRegistry(stale_after=stale_after)
+        self.heartbeats = HeartbeatMonitor()
+        self.stale_check_interval = 1.0
 
-        self.publisher = Publisher(
+        self.publisher = RoutedPublisher(
             host=outbound[0],
             port=outbound[1], 
             bound=outbound[2])
@@ -53,35 +149,109 @@ class Hub():
             bound=inbound[2],
             name=self.name)
 
-        self.server = ObjectServer(
-            obj=self,
-            port=server_port)
+        if concurrent:
+            self.server = ConcurrentObjectServer(
+                obj=self,
+                port=server_port)
+        else:
+            self.server = ObjectServer(
+                obj=self,
+                port=server_port)
 
         self.poller = zmq.Poller()
 
         self.running = False
 
     def send(self, msg):
-        """Publish a message."""
+        """Publish a message. Requests to a concurrent server run on worker
+        threads, so sending is serialized."""
+
+        with self.send_lock:
+            self.publisher.send(msg)
+
+    def set_properties(self, properties: Dict[str, Any]):
+        """Record the status of devices, keep them as attributes of the hub
+        as well, and publish what changed."""
+
+        changes = {}
+        for (key, value) in properties.items():
+            if isinstance(value, dict):
+                diff = self.status.update(key, value)
+                if diff:
+                    changes[key] = diff
+            self.__setattr__(key, value)
+
+        if changes:
+            self.send("status " + json.dumps(changes, default=str))
+
+    def heartbeat(self, device: str, rate: float, cpu: float, rss: int,
+                  interval: float):
+        """Record a beat of a device."""
+
+        revived = self.heartbeats.beat(
+            device, {"rate": rate, "cpu": cpu, "max_rss_kb": rss}, interval)
+        self.status.touch(device)
+
+        if revived:
+            self.send("status " + json.dumps({device: {"alive": True}}))
+
+    def check_heartbeats(self):
+        """Publish the devices that missed a beat."""
 
-        self.publisher.send(msg)
+        missed = self.heartbeats.check()
+        if missed:
+            self.send("status " + json.dumps(
+                {device: {"alive": False} for device in missed}))
+
+    def check_stale(self):
+        """Publish the devices that went stale."""
+
+        stale = self.status.check_stale()
+        if stale:
+            self.send("status " + json.dumps(
+                {device: {"stale": True} for device in stale}))
 
     def loop(self):
         """Handle messages received by server/subscriber."""
 
-        self.poller.register(self.subscriber.socket)
-        self.poller.register(self.server.socket)
+        # A ROUTER socket is always writable, so only poll for input.
+        self.poller.register(self.subscriber.socket, zmq.POLLIN)
+        self.poller.register(self.server.socket, zmq.POLLIN)
+
+        results = getattr(self.server, "results", None)
+        if results is not None:
+            self.poller.register(results, zmq.POLLIN)
+
+        next_check = time.monotonic() + self.stale_check_interval
 
         while self.running:
 
-            sockets = dict(self.poller.poll())
+            wake = next_check
+            deadline = self.heartbeats.next_deadline()
+            if deadline is not None:
+                wake = min(wake, deadline)
+            timeout = max(int((wake - time.monotonic()) * 1000) + 1, 0)
+
+            sockets = dict(self.poller.poll(timeout))
+
+            self.check_heartbeats()
+
+            if time.monotonic() >= next_check:
+                self.check_stale()
+                next_check = time.monotonic() + self.stale_check_interval
 
             if self.subscriber.socket in sockets:
                 self.subscriber.handle()
 
+            if results is not None and results in sockets:
+                self.server.handle_result()
+
             if self.server.socket in sockets:
                 self.server.handle()
 
+        if results is not None:
+            self.server.drain()
+
     def run(self):
         """Start looping."""
 
@@ -99,7 +269,8 @@ def main():
     outbound = parse_host_and_port(arguments["--outbound"])
     server_port = int(arguments["--serve"])
 
-    scope = Hub(inbound, outbound, server_port)
+    scope = Hub(inbound, outbound, server_port,
+                concurrent=arguments["--concurrent"])
     scope.run()
 
 if __name__ == "__main__":
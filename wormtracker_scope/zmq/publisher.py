@@ -14,19 +14,32 @@ Options:
     --address=ADDRESS     Socket address. [default: 5004]
 """
 
-from typing import Union
+import time
+from typing import Callable, Iterable, Union
 
 import zmq
+import zmq.asyncio
 from docopt import docopt
 
 from wormtracker_scope.zmq.utils import (
+    async_context,
     address_from_host_and_port,
     parse_host_and_port,
-    connect_or_bind
+    connect_or_bind,
+    pack_command,
+    coerce_bytes,
+    coerce_string,
+    message_topic,
+    topic_lane,
+    lane_address,
+    LANE_OFFSETS
 )
 
 class Publisher():
-    """This wraps a ZMQ PUB socket."""
+    """This wraps a ZMQ XPUB socket, which publishes like a PUB socket and
+    also receives the subscriptions of its peers. Waiting for the
+    subscriptions of the devices a message is meant for, instead of
+    sleeping, avoids losing messages to slow joiners."""
 
     def __init__(
             self,
@@ -38,8 +51,9 @@ class Publisher():
         self.host = host
         self.bound = bound
 
-        self.context = zmq.Context.instance()
-        self.socket = self.context.socket(zmq.PUB)
+        self.context = self.get_context()
+        self.socket = self.context.socket(zmq.XPUB)
+        self.subscriptions = {self.socket: set()}
 
         self.address = address_from_host_and_port(self.host, self.port, self.bound)
 
@@ -47,6 +61,11 @@ class Publisher():
 
         self.running = False
 
+    def get_context(self) -> zmq.Context:
+        """Return the context to create the socket in."""
+
+        return zmq.Context.instance()
+
     def connect(self):
         """Connect or bind to the socket address."""
 
@@ -60,6 +79,77 @@ class Publisher():
         elif isinstance(msg, str):
             self.socket.send_string(msg)
 
+    def send_command(self, topic: str, method: str, *args: Union[int, float]):
+        """Send a command with numeric arguments in the compact binary
+        encoding understood by ObjectSubscriber."""
+
+        self.socket.send(pack_command(topic, method, *args))
+
+    def get_socket(self, topic: str):
+        """Return the socket messages on topic are sent with."""
+        return self.socket
+
+    def poll_subscriptions(self, timeout: float):
+        """Wait up to timeout seconds for subscription changes and apply
+        all that are available."""
+
+        poller = zmq.Poller()
+        for socket in self.subscriptions:
+            poller.register(socket, zmq.POLLIN)
+
+        for (socket, _) in poller.poll(int(timeout * 1000)):
+            while socket.poll(0):
+                self.apply_subscription(socket, socket.recv())
+
+    def apply_subscription(self, socket, msg: bytes):
+        """Record a subscription or unsubscription received on socket."""
+
+        if msg[:1] == b"\1":
+            self.subscriptions[socket].add(msg[1:])
+        elif msg[:1] == b"\0":
+            self.subscriptions[socket].discard(msg[1:])
+
+    def has_subscriber(self, topic: str) -> bool:
+        """Return whether a message on topic would reach a subscriber, as
+        of the last poll_subscriptions."""
+
+        topic = coerce_bytes(topic)
+        return any(topic.startswith(prefix)
+                   for prefix in self.subscriptions[self.get_socket(topic)])
+
+    def wait_until(self, condition: Callable[[], bool], timeout: float) -> bool:
+        """Process subscription changes until condition() is true or timeout
+        seconds pass, and return condition()."""
+
+        deadline = time.monotonic() + timeout
+
+        self.poll_subscriptions(0)
+        while not condition():
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            self.poll_subscriptions(remaining)
+
+        return True
+
+    def wait_for_subscribers(self, topics: Iterable[str], timeout=1.0) -> bool:
+        """Block until every topic has a subscriber, or timeout seconds
+        pass. Return whether all topics have subscribers."""
+
+        topics = list(topics)
+        return self.wait_until(
+            lambda: all(self.has_subscriber(topic) for topic in topics),
+            timeout)
+
+    def wait_for_unsubscribed(self, topics: Iterable[str], timeout=1.0) -> bool:
+        """Block until no topic has a subscriber, for example because the
+        devices listening to them shut down, or timeout seconds pass."""
+
+        topics = list(topics)
+        return self.wait_until(
+            lambda: not any(self.has_subscriber(topic) for topic in topics),
+            timeout)
+
     def loop(self):
         """Keep sending messages."""
 
@@ -76,6 +166,123 @@ class Publisher():
         self.running = True
         self.loop()
 
+class RoutedPublisher(Publisher):
+    """This publishes to every lane of the bus, choosing the lane of each
+    message from its topic (see TOPIC_LANES). Messages to one device stay in
+    order, but messages on different lanes are not ordered with each other.
+    The address given is the one of the bulk lane."""
+
+    def __init__(
+            self,
+            port: int,
+            host="localhost",
+            bound=True,
+            lanes: Iterable[str] = tuple(LANE_OFFSETS)):
+
+        Publisher.__init__(self, port, host, bound)
+
+        self.sockets = {}
+        for lane in lanes:
+            (lane_host, lane_port, _) = lane_address((host, port, bound), lane)
+            if lane_port == port and lane_host == host:
+                self.sockets[lane] = self.socket
+                continue
+
+            socket = self.context.socket(zmq.XPUB)
+            self.subscriptions[socket] = set()
+            connect_or_bind(
+                socket,
+                address_from_host_and_port(lane_host, lane_port, bound),
+                bound)
+            self.sockets[lane] = socket
+
+    def get_socket(self, topic: Union[str, bytes]):
+        """Return the socket of the lane a topic is routed on."""
+        return self.sockets.get(topic_lane(coerce_string(topic)), self.socket)
+
+    def send(self, msg: Union[str, bytes]):
+        """Send a single message on the lane of its topic."""
+
+        msg = coerce_bytes(msg)
+        self.get_socket(message_topic(msg)).send(msg)
+
+    def send_command(self, topic: str, method: str, *args: Union[int, float]):
+        """Send a binary command on the lane of its topic."""
+
+        self.get_socket(topic).send(pack_command(topic, method, *args))
+
+class AsyncPublisher(Publisher):
+    """This wraps a ZMQ XPUB socket for use in asyncio coroutines. The
+    methods that wait for subscriptions are coroutines here."""
+
+    def get_context(self) -> zmq.asyncio.Context:
+        return async_context()
+
+    async def send(self, msg: Union[str, bytes]):
+        """Send a single message."""
+
+        if isinstance(msg, bytes):
+            await self.socket.send(msg)
+        elif isinstance(msg, str):
+            await self.socket.send_string(msg)
+
+    async def send_command(self, topic: str, method: str,
+                           *args: Union[int, float]):
+        """Send a command in binary."""
+
+        await self.socket.send(pack_command(topic, method, *args))
+
+    async def poll_subscriptions(self, timeout: float):
+        """Wait up to timeout seconds for subscription changes and apply
+        all that are available."""
+
+        poller = zmq.asyncio.Poller()
+        for socket in self.subscriptions:
+            poller.register(socket, zmq.POLLIN)
+
+        for (socket, _) in await poller.poll(int(timeout * 1000)):
+            while True:
+                try:
+                    msg = await socket.recv(flags=zmq.NOBLOCK)
+                except zmq.error.Again:
+                    break
+                self.apply_subscription(socket, msg)
+
+    async def wait_until(self, condition: Callable[[], bool],
+                         timeout: float) -> bool:
+        """Process subscription changes until condition() is true or timeout
+        seconds pass, and return condition()."""
+
+        deadline = time.monotonic() + timeout
+
+        await self.poll_subscriptions(0)
+        while not condition():
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            await self.poll_subscriptions(remaining)
+
+        return True
+
+    async def wait_for_subscribers(self, topics: Iterable[str],
+                                   timeout=1.0) -> bool:
+        """Wait until every topic has a subscriber, or timeout seconds
+        pass. Return whether all topics have subscribers."""
+
+        topics = list(topics)
+        return await self.wait_until(
+            lambda: all(self.has_subscriber(topic) for topic in topics),
+            timeout)
+
+    async def wait_for_unsubscribed(self, topics: Iterable[str],
+                                    timeout=1.0) -> bool:
+        """Wait until no topic has a subscriber, or timeout seconds pass."""
+
+        topics = list(topics)
+        return await self.wait_until(
+            lambda: not any(self.has_subscriber(topic) for topic in topics),
+            timeout)
+
 def main():
     """CLI entry point."""
 
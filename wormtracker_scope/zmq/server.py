@@ -14,13 +14,18 @@ Options:
     --port=PORT           Socket port. [default: 5002]
 """
 
+import json
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
 import zmq
 from docopt import docopt
 
 from wormtracker_scope.zmq.utils import (
     coerce_string,
     coerce_bytes,
-    try_num
+    make_dispatch_table
 )
 
 class Server():
@@ -29,12 +34,13 @@ class Server():
     def __init__(
             self,
             port: int,
-            name="Server"):
+            name="Server",
+            socket_type=zmq.REP):
 
         self.name = name
 
         self.context = zmq.Context.instance()
-        self.socket = self.context.socket(zmq.REP)
+        self.socket = self.context.socket(socket_type)
 
         address = "tcp://*:{}".format(port)
         self.socket.bind(address)
@@ -79,36 +85,159 @@ class ObjectServer(Server):
     def __init__(self, port, obj):
         Server.__init__(self, port)
         self.obj = obj
+        self.commands = make_dispatch_table(obj)
 
     def process(self, req: bytes):
 
+        self.send(coerce_bytes(self.reply(req)))
+
+    def reply(self, req: bytes) -> str:
+        """Carry out a request and return the reply."""
+
         req_str = coerce_string(req)
         req_parts = req_str.split(" ")
 
         if len(req_parts) <= 1:
-            rep = "Command should at least have 2 parts."
-            
-        else:
-            op = req_parts[0]
-            attr = req_parts[1]
-            args = req_parts[2:]
-            args = tuple(map(try_num, args))
-
-            try:
-                if op == "GET":
-                    rep = str(self.obj.__getattribute__(attr))
-
-                elif op == "DO":
-                    fn = self.obj.__getattribute__(attr)
-                    fn(*args)
-                    rep = "request completed."
+            return "Command should at least have 2 parts."
+
+        op = req_parts[0]
+        attr = req_parts[1]
+        args = req_parts[2:]
+
+        try:
+            if op == "GET":
+                value = self.obj.__getattribute__(attr)
+                for key in args:
+                    value = value[key]
+
+                if isinstance(value, (dict, list)):
+                    rep = json.dumps(value, default=str)
+                else:
+                    rep = str(value)
+
+            elif op == "DO":
+                command = self.commands.get(attr)
+                if command is None:
+                    rep = "Unknown command: {}".format(attr)
                 else:
-                    rep = "Commands should start with 'DO' or 'GET'."
+                    command(args)
+                    rep = "request completed."
+            else:
+                rep = "Commands should start with 'DO' or 'GET'."
+
+        except Exception as exc:
+            rep = str(exc)
+
+        return rep
+
+class ConcurrentObjectServer(ObjectServer):
+    """This is an ObjectServer on a ROUTER socket. DO requests run on a pool
+    of worker threads, so a slow command does not block other clients, and
+    GET requests are answered right away even while DOs are in flight.
+
+    Requests from REQ clients are answered like a REP server would. Requests
+    from a PipelinedClient carry a request id, which is echoed in the reply
+    so that replies can be matched to requests in any order. Requests of one
+    client are carried out in the order they were sent: while a DO of a
+    client is running, its later requests wait in self.queues, so scripts
+    can pipeline their steps safely. Replies of workers are passed
+    back to the thread that owns the ROUTER socket through self.results,
+    which has to be polled along with self.socket."""
+
+    def __init__(self, port, obj, max_workers=4):
+
+        Server.__init__(self, port, socket_type=zmq.ROUTER)
+
+        self.obj = obj
+        self.commands = make_dispatch_table(obj)
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+
+        self.results_address = "inproc://results_{}".format(id(self))
+        self.results = self.context.socket(zmq.PULL)
+        self.results.bind(self.results_address)
+        self.local = threading.local()
+        self.queues = {}
+
+    def handle(self):
+        """Receive a request and either answer it or pass it to a worker."""
+
+        frames = self.socket.recv_multipart()
+        if b"" not in frames[1:-1]:
+            # Without a delimiter and a request, there is nothing to reply to.
+            print("Dropped a malformed request: {}".format(frames))
+            return
+
+        delimiter = frames.index(b"", 1)
+        envelope = frames[:delimiter + 1]
+        (*request_id, req) = frames[delimiter + 1:]
+
+        client = tuple(envelope)
+        if client in self.queues:
+            self.queues[client].append((envelope + request_id, req))
+        else:
+            self.dispatch(client, deque([(envelope + request_id, req)]))
+
+    def dispatch(self, client: tuple, queue: deque):
+        """Answer the queued requests of a client up to its next DO, and
+        pass that DO to a worker."""
+
+        while queue:
+            (header, req) = queue.popleft()
+            if req.startswith(b"DO "):
+                self.queues[client] = queue
+                self.executor.submit(self.work, header, req)
+                return
+
+            self.socket.send_multipart(
+                header + [coerce_bytes(self.reply(req))])
+
+    def work(self, header, req: bytes):
+        """Carry out a request in a worker thread and queue the reply."""
+
+        if not hasattr(self.local, "socket"):
+            self.local.socket = self.context.socket(zmq.PUSH)
+            self.local.socket.connect(self.results_address)
+
+        self.local.socket.send_multipart(
+            header + [coerce_bytes(self.reply(req))])
+
+    def handle_result(self):
+        """Send a reply queued by a worker to its client, and carry on with
+        the requests of the client that waited for it."""
+
+        frames = self.results.recv_multipart()
+        self.socket.send_multipart(frames)
+
+        client = tuple(frames[:frames.index(b"", 1) + 1])
+        self.dispatch(client, self.queues.pop(client))
+
+    def drain(self):
+        """Wait for the DOs in flight and send their replies, without
+        starting the requests queued behind them. A DO such as shutdown can
+        stop the loop before its reply has been sent."""
+
+        self.executor.shutdown(wait=True)
+        while self.results.poll(0):
+            self.socket.send_multipart(self.results.recv_multipart())
+
+    def run(self):
+        """Start looping."""
+
+        poller = zmq.Poller()
+        poller.register(self.socket, zmq.POLLIN)
+        poller.register(self.results, zmq.POLLIN)
+
+        self.running = True
+        while self.running:
+            sockets = dict(poller.poll())
+
+            if self.results in sockets:
+                self.handle_result()
 
-            except Exception as exc:
-                rep = str(exc)
+            if self.socket in sockets:
+                self.handle()
 
-        self.send(coerce_bytes(rep))
+        self.drain()
 
 def main():
     """CLI entry point."""
@@ -14,20 +14,28 @@ Options:
     --address=ADDRESS     Socket address. [default: L5004]
 """
 
-from typing import Union, Optional
+from typing import Iterable, Union, Optional
 import json
+import inspect
 
 import zmq
+import zmq.asyncio
 from docopt import docopt
 
 from wormtracker_scope.zmq.utils import (
+    async_context,
     address_from_host_and_port,
     parse_host_and_port,
     connect_or_bind,
     coerce_string,
     coerce_bytes,
     get_last,
-    try_num
+    make_dispatch_table,
+    command_id,
+    unpack_command,
+    describe_message,
+    lane_address,
+    BINARY_MARKER
 )
 
 class Subscriber():
@@ -37,13 +45,14 @@ class Subscriber():
             self,
             port: int,
             host="localhost",
-            bound=False):
+            bound=False,
+            lanes: Iterable[str] = ()):
 
         self.port = port
         self.host = host
         self.bound = bound
 
-        self.context = zmq.Context.instance()
+        self.context = self.get_context()
         self.socket = self.context.socket(zmq.SUB)
 
         self.address = address_from_host_and_port(self.host,
@@ -51,15 +60,34 @@ class Subscriber():
                                                   self.bound)
 
         self.connect()
+        self.connect_lanes(lanes)
         self.add_subscription("")
 
         self.running = False
 
+    def get_context(self) -> zmq.Context:
+        """Return the context to create the socket in."""
+
+        return zmq.Context.instance()
+
     def connect(self):
         """Connect or bind to the socket address."""
 
         connect_or_bind(self.socket, self.address, self.bound)
 
+    def connect_lanes(self, lanes: Iterable[str]):
+        """Also receive from other lanes of the bus. Each lane has its own
+        queue, which is read in turn with the others, so messages on a
+        quiet lane do not wait behind a busy one."""
+
+        for lane in lanes:
+            (host, port, bound) = lane_address(
+                (self.host, self.port, self.bound), lane)
+            if (host, port) != (self.host, self.port):
+                connect_or_bind(self.socket,
+                                address_from_host_and_port(host, port, bound),
+                                bound)
+
     def add_subscription(self, x: Union[bytes, str]):
         """Add a subscription."""
 
@@ -100,7 +128,7 @@ class Subscriber():
     def process(self, msg: bytes):
         """Decode and print a message."""
 
-        msg = coerce_string(msg)
+        msg = describe_message(msg)
         print("Subscriber received message: {}".format(msg[:1000]))
 
     def handle(self):
@@ -132,12 +160,17 @@ class ObjectSubscriber(Subscriber):
             port: int,
             host: str = "localhost",
             bound=False,
-            name: Optional[str] = None):
+            name: Optional[str] = None,
+            lanes: Iterable[str] = ()):
 
-        Subscriber.__init__(self, port, host, bound)
+        Subscriber.__init__(self, port, host, bound, lanes)
 
         self.obj = obj
         self.name = name
+        self.commands = make_dispatch_table(obj)
+        self.command_ids = {command_id(fn_name): command
+                            for (fn_name, command) in self.commands.items()}
+        self.topic_length = 0 if name is None else len(coerce_bytes(name))
 
         if name is None:
             self.add_subscription("")
@@ -152,11 +185,23 @@ class ObjectSubscriber(Subscriber):
             arguments 5.0 (float) and "espresso" (str).
 
         b"obj_name {"prop1": 5, "prop2": "on"}": Update properties prop1
-            and prop2 (JSON-decoded). Custom setters will be called.
+            and prop2 (JSON-decoded). Custom setters will be called. If the
+            object has a set_properties method, it receives the whole
+            dictionary instead.
+
+        b"obj_name\0...": Call a method with numeric arguments encoded by
+            pack_command.
+
+        Arguments are converted according to the annotations of the method
+        (see Command), and unknown methods are rejected.
         """
         try:
+            marker_end = self.topic_length + 1
+            if msg[self.topic_length:marker_end] == BINARY_MARKER:
+                return self.process_binary(msg[marker_end:])
+
             if self.name is not None:
-                msg = b" ".join(msg.split(b" ")[1:])
+                msg = msg.partition(b" ")[2]
 
             msg_str = coerce_string(msg)
 
@@ -164,6 +209,11 @@ class ObjectSubscriber(Subscriber):
 
                 msg_dict = json.loads(msg_str)
 
+                set_properties = getattr(self.obj, "set_properties", None)
+                if set_properties is not None:
+                    set_properties(msg_dict)
+                    return None
+
                 for key, val in msg_dict.items():
                     self.obj.__setattr__(key, val)
 
@@ -171,19 +221,86 @@ class ObjectSubscriber(Subscriber):
 
                 msg_parts = msg_str.split(" ")
 
-                fn_str = msg_parts[0]
-                args = []
-
-                if len(msg_parts) > 1:
-                    args_str = msg_parts[1:]
-                    args = map(try_num, args_str)
+                command = self.commands.get(msg_parts[0])
+                if command is None:
+                    print("Unknown command: {}".format(msg_parts[0]))
+                    return None
 
-                fn = self.obj.__getattribute__(fn_str)
-                fn(*args)
+                return command(msg_parts[1:])
 
         except Exception as exc:
             print(str(exc))
 
+    def process_binary(self, body: bytes):
+        """Call the method a binary command refers to."""
+
+        (method_id, args) = unpack_command(body)
+
+        command = self.command_ids.get(method_id)
+        if command is None:
+            print("Unknown command id: {:08x}".format(method_id))
+            return None
+
+        return command.fn(*args)
+
+class AsyncSubscriber(Subscriber):
+    """This wraps a ZMQ SUB socket for use in asyncio coroutines."""
+
+    def get_context(self) -> zmq.asyncio.Context:
+        return async_context()
+
+    async def recv(self) -> bytes:
+        """Receive a message."""
+
+        return await self.socket.recv()
+
+    async def recv_string(self) -> str:
+        """Receive a message."""
+
+        return await self.socket.recv_string()
+
+    async def recv_last(self) -> Optional[bytes]:
+        """Receive the last message sent, or None if none are present."""
+
+        msg = None
+
+        while True:
+            try:
+                msg = await self.socket.recv(flags=zmq.NOBLOCK)
+            except zmq.error.Again:
+                return msg
+
+    async def flush(self):
+        """Receive and dump all available messages."""
+
+        _ = await self.recv_last()
+
+    async def handle(self):
+        """Receive and process a message. If processing returns an awaitable,
+        as calling a coroutine method does, wait for it."""
+
+        req = await self.recv()
+        result = self.process(req)
+        if inspect.isawaitable(result):
+            await result
+
+    async def loop(self):
+        """Keep handling messages."""
+
+        await self.flush()
+        while self.running:
+            await self.handle()
+
+    async def run(self):
+        """Handle messages until running is cleared."""
+
+        self.running = True
+        await self.loop()
+
+class AsyncObjectSubscriber(AsyncSubscriber, ObjectSubscriber):
+    """This is an ObjectSubscriber for use in asyncio coroutines. Commands
+    that are coroutine methods of the object are awaited."""
+
 def main():
     """CLI entry point."""
 
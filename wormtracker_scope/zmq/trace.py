@@ -0,0 +1,100 @@
+#! python
+#
+# Copyright 2022
+# Author: Mahdi Torkashvand
+
+"""This contains tools to trace the latency of frames as they move between
+devices.
+
+A trace is a trailer of stamps sent as an optional last frame of a
+timestamped array message. Each stage appends a stamp with its name and
+time.perf_counter_ns(), which reads a system wide monotonic clock, so stamps
+from different processes on the same host can be compared. A
+LatencyCollector turns traces into latency histograms between consecutive
+stages."""
+
+import time
+import struct
+from typing import Dict, List, Tuple
+
+_STAMP = struct.Struct("<16sQ")
+
+def add_stamp(trace: bytearray, stage: str):
+    """Append a stamp for stage to trace."""
+    trace += _STAMP.pack(stage.encode("ascii"), time.perf_counter_ns())
+
+def read_stamps(trace: bytes) -> List[Tuple[str, int]]:
+    """Return the (stage, time in ns) stamps in a trace."""
+    return [(stage.rstrip(b"\0").decode("ascii"), t)
+            for (stage, t) in _STAMP.iter_unpack(trace)]
+
+class LatencyCollector():
+    """This accumulates histograms of the latency between consecutive stages
+    of traces. Bucket i counts latencies of less than 2**i microseconds
+    that did not fit in bucket i-1."""
+
+    def __init__(self, n_buckets=24):
+
+        self.n_buckets = n_buckets
+        self.histograms = {}
+        self.totals = {}
+        self.maxima = {}
+
+    def add(self, trace: bytes):
+        """Add the latencies in a trace to the histograms."""
+
+        stamps = read_stamps(trace)
+
+        for ((start, t0), (end, t1)) in zip(stamps[:-1], stamps[1:]):
+
+            key = "{}>{}".format(start, end)
+            latency_us = max(t1 - t0, 0) // 1000
+
+            if key not in self.histograms:
+                self.histograms[key] = [0] * self.n_buckets
+                self.totals[key] = 0
+                self.maxima[key] = 0
+
+            bucket = min(latency_us.bit_length(), self.n_buckets - 1)
+            self.histograms[key][bucket] += 1
+            self.totals[key] += latency_us
+            self.maxima[key] = max(self.maxima[key], latency_us)
+
+    def percentile(self, key: str, q: float) -> int:
+        """Return an upper bound in microseconds of the q-th percentile of
+        the latency of key."""
+
+        histogram = self.histograms[key]
+        target = q / 100 * sum(histogram)
+        count = 0
+
+        for (bucket, n) in enumerate(histogram):
+            count += n
+            if count >= target:
+                return min(2 ** bucket, self.maxima[key])
+
+        return self.maxima[key]
+
+    def summary(self) -> Dict[str, Dict[str, int]]:
+        """Return the count, mean, median, 99th percentile, and maximum
+        latency in microseconds between every pair of stages."""
+
+        summary = {}
+
+        for (key, histogram) in self.histograms.items():
+            count = sum(histogram)
+            summary[key] = {
+                "count": count,
+                "mean_us": self.totals[key] // count,
+                "p50_us": self.percentile(key, 50),
+                "p99_us": self.percentile(key, 99),
+                "max_us": self.maxima[key]}
+
+        return summary
+
+    def reset(self):
+        """Clear all histograms."""
+
+        self.histograms = {}
+        self.totals = {}
+        self.maxima = {}
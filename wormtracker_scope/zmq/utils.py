@@ -5,11 +5,44 @@
 
 """This module contains utilities used in zmq modules."""
 
+import re
 import time
+import zlib
 import struct
-from typing import Union, Tuple
+import inspect
+import typing
+from functools import lru_cache
+from typing import Any, Callable, Dict, List, Union, Tuple, Optional
 
 import zmq
+import zmq.asyncio
+
+_LOCAL_TRANSPORTS = ("ipc", "inproc")
+
+# The bus is split into lanes, each with its own forwarder, so that high
+# rate motion commands do not queue behind status and log messages. The
+# ports of a lane are the ports of the bus shifted by its offset. Topics
+# that are not in TOPIC_LANES go on the bulk lane.
+#
+# The topic of a command is the device it is sent to, so every command to a
+# device, including shutdown and other safety commands, travels on one lane
+# and arrives in the order it was sent. There is no ordering between lanes:
+# a command to one device can overtake an earlier command to another, e.g.
+# a realtime move of the stage can arrive before a bulk "tracker stop" sent
+# just before it. A device that stops the stage must do so with a command to
+# the stage, as the tracker does when it stops. Devices on a lane other than
+# bulk also listen on bulk, for tools such as wormtracker_publisher that do
+# not route by lane; those messages are not ordered with the lane of the
+# device, so devices should send to each other with a RoutedPublisher.
+LANE_OFFSETS = {
+    "bulk": 0,
+    "realtime": 10
+}
+TOPIC_LANES = {
+    "teensy_commands": "realtime"
+}
+
+_TOPIC = re.compile(rb"[^ \0]*")
 
 def coerce_string(x: Union[bytes, str]) -> str:
     """Convert bytes to a string."""
@@ -35,21 +68,164 @@ def try_num(s: str) -> Union[str, float, int]:
         except ValueError:
             return s
 
+def _parse_bool(s: str) -> bool:
+    """Interpret a command argument as a boolean."""
+    return s in ("1", "true", "True")
+
+_CONVERTERS = {
+    int: int,
+    float: float,
+    str: str,
+    bool: _parse_bool
+}
+
+class Command():
+    """This is a method exposed to the message bus, with a converter for each
+    of its arguments. Arguments annotated as int, float, str, or bool are
+    converted to that type, and all others with try_num."""
+
+    __slots__ = ("fn", "converters")
+
+    def __init__(self, fn: Callable):
+
+        self.fn = fn
+        self.converters = []
+
+        try:
+            parameters = inspect.signature(fn).parameters.values()
+        except (TypeError, ValueError):
+            return
+
+        try:
+            hints = typing.get_type_hints(fn)
+        except Exception:
+            hints = {}
+
+        for parameter in parameters:
+            if parameter.kind not in (parameter.POSITIONAL_ONLY,
+                                      parameter.POSITIONAL_OR_KEYWORD):
+                break
+            hint = hints.get(parameter.name)
+            self.converters.append(_CONVERTERS.get(hint, try_num))
+
+    def __call__(self, args: List[str]) -> Any:
+        """Convert the arguments and call the method with them."""
+
+        converters = self.converters
+        if len(args) > len(converters):
+            converters = converters + [try_num] * (len(args) - len(converters))
+
+        return self.fn(*[convert(arg) for (convert, arg) in zip(converters, args)])
+
+def make_dispatch_table(obj) -> Dict[str, Command]:
+    """Return a table of Commands for every method of obj, keyed by name.
+    This is built once, so lookups cost a single dictionary access."""
+
+    table = {}
+
+    for name in dir(type(obj)):
+        if name.startswith("__"):
+            continue
+        if callable(getattr(type(obj), name, None)):
+            table[name] = Command(getattr(obj, name))
+
+    return table
+
+# Binary commands are sent as the topic, a zero byte, the command header
+# (method id, number of arguments), one type code per argument ("q" for
+# int64, "d" for float64), and the packed arguments. The method id is the
+# CRC32 of the method name, so no registry has to be shared between
+# producers and consumers.
+BINARY_MARKER = b"\0"
+_COMMAND_HEADER = struct.Struct("<IB")
+
+def command_id(method: str) -> int:
+    """Return the id of a method in binary commands."""
+    return zlib.crc32(method.encode("ascii"))
+
+@lru_cache(maxsize=None)
+def _args_struct(types: bytes) -> struct.Struct:
+    return struct.Struct("<" + types.decode("ascii"))
+
+def pack_command(topic: str, method: str, *args: Union[int, float]) -> bytes:
+    """Encode a command with numeric arguments in binary."""
+
+    types = b"".join(b"q" if hasattr(arg, "__index__") else b"d" for arg in args)
+
+    return (coerce_bytes(topic) + BINARY_MARKER
+            + _COMMAND_HEADER.pack(command_id(method), len(args))
+            + types + _args_struct(types).pack(*args))
+
+def unpack_command(body: bytes) -> Tuple[int, tuple]:
+    """Decode the part of a binary command following the marker into the
+    method id and the arguments."""
+
+    (method_id, nargs) = _COMMAND_HEADER.unpack_from(body)
+    offset = _COMMAND_HEADER.size
+    types = body[offset:offset + nargs]
+    args = _args_struct(types).unpack_from(body, offset + nargs)
+
+    return (method_id, args)
+
+def describe_message(msg: bytes) -> str:
+    """Return a printable form of a text or binary message."""
+
+    (topic, marker, body) = msg.partition(BINARY_MARKER)
+    if not marker:
+        return msg.decode("utf-8", errors="replace")
+
+    (method_id, args) = unpack_command(body)
+    return "{} #{:08x} {}".format(coerce_string(topic), method_id,
+                                  " ".join(map(str, args)))
+
+def message_topic(msg: bytes) -> str:
+    """Return the topic of a text or binary message."""
+    return _TOPIC.match(msg).group().decode("utf-8", errors="replace")
+
+def topic_lane(topic: str) -> str:
+    """Return the lane a topic is routed on."""
+    return TOPIC_LANES.get(topic, "bulk")
+
+def lane_address(
+        address: Tuple[str, Optional[int], bool],
+        lane: str
+    ) -> Tuple[str, Optional[int], bool]:
+    """Return the (host, port, bound) of a lane of the bus at address. IPC
+    and in-process endpoints of lanes other than bulk get a suffix."""
+
+    (host, port, bound) = address
+
+    if port is not None:
+        return (host, port + LANE_OFFSETS[lane], bound)
+
+    if LANE_OFFSETS[lane] == 0:
+        return address
+
+    return ("{}_{}".format(host, lane), None, bound)
+
 def address_from_host_and_port(
         host: str,
-        port: int,
+        port: Optional[int],
         bound: bool = False
     ) -> str:
     """Return a TCP address for a given host and port. If the address is meant
-    to be bound, it will be bound to all available TCP interfaces (*)."""
+    to be bound, it will be bound to all available TCP interfaces (*). If port
+    is None, host is already a complete (ipc:// or inproc://) endpoint."""
 
-    if bound:
+    if port is None:
+        address = host
+    elif bound:
         address = "tcp://*:{}".format(port)
     else:
         address = "tcp://{}:{}".format(host, port)
 
     return address
 
+def async_context() -> zmq.asyncio.Context:
+    """Return an asyncio context sharing the global context, so that inproc
+    endpoints work between synchronous and asyncio sockets."""
+    return zmq.asyncio.Context.shadow(zmq.Context.instance())
+
 def connect_or_bind(socket, address: str, bound: bool):
     """Connect or bind the socket to address."""
     if bound:
@@ -75,16 +251,34 @@ def get_last(receiver):
     return msg
 
 
-def parse_host_and_port(val: str) -> Tuple[str, int, bool]:
+def parse_host_and_port(val: str) -> Tuple[str, Optional[int], bool]:
     """This takes a command line argument specifying a host/port and returns
-    a tuple of (host, port, bound) to determine a TCP endpoint:
+    a tuple of (host, port, bound) to determine an endpoint:
 
-    5000            -> ("*", 5000, True)
-    localhost:5000  -> ("localhost", 5000, False)
-    *:5000          -> ("*", 5000, True)
-    L5000           -> ("localhost", 5000, False)
+    5000                -> ("*", 5000, True)
+    localhost:5000      -> ("localhost", 5000, False)
+    *:5000              -> ("*", 5000, True)
+    L5000               -> ("localhost", 5000, False)
+
+    IPC and in-process endpoints are connected to unless prefixed with *,
+    and are returned whole with no port:
+
+    ipc:/tmp/wt-data    -> ("ipc:///tmp/wt-data", None, False)
+    *ipc:/tmp/wt-data   -> ("ipc:///tmp/wt-data", None, True)
+    inproc:data         -> ("inproc://data", None, False)
     """
 
+    bound = val.startswith("*")
+    transport = val.lstrip("*").split(":", 1)
+
+    if transport[0] in _LOCAL_TRANSPORTS and len(transport) == 2:
+
+        (scheme, path) = transport
+        if path.startswith("//"):
+            path = path[2:]
+
+        return ("{}://{}".format(scheme, path), None, bound)
+
     parts = val.split(":")
 
     if len(parts) == 1: